@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timings of fire, pipe and segment criticality analyses.
+
+For each network, times:
+
+* load - reading the .inp file, or generating the synthetic network
+* baseline - the baseline simulation and serialized wn every analysis starts
+  from (pipe/segment durations, checkpointed at the break for the
+  WNTRSimulator), with each simulator
+* inp_to_geojson - the geojson layer of the network used by the maps
+
+and for each analysis and simulator, serially and with each number of worker
+processes:
+
+* analysis - the whole analysis, without post processing
+* scenario_sim - the simulation time of the scenarios, summed over them
+  (mean, median, p95 and max per scenario in the record)
+
+and, from the serial run:
+
+* summary_write - writing the .yml and .npz summaries of the results
+* process_criticality - the csv and pdf map outputs
+* map - the interactive .html map (fire and pipe only)
+
+With --synthetic, synthetic networks of each given number of junctions are
+benchmarked instead of .inp files, for scaling curves of each stage.
+
+The records are saved as json, with the commit, versions and machine they
+were taken on, so runs can be compared across commits with --compare.
+
+Usage:
+    python bench_criticality.py [--inp NETWORK.inp ...] [--analyses fire pipe
+        segment] [--simulators wntr epanet] [--workers 1 2 4]
+        [--output RESULTS.json]
+    python bench_criticality.py --synthetic 100 1000 10000 [--topology grid
+        tree mixed] [--analyses ...] [--workers ...] [--output RESULTS.json]
+    python bench_criticality.py --compare OLD.json NEW.json
+"""
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+import yaml
+import wntr
+import criticalityMaps as cm
+from criticalityMaps.criticality.core import (_set_PDD_params, _get_nzd_nodes,
+                                              _get_lowP_nodes)
+from criticalityMaps.synthetic import synthetic_network
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NET3 = os.path.join(BENCH_DIR, '..', 'examples', 'Net3.inp')
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_network(network, load, analyses, simulators, worker_counts,
+                  records):
+
+    def record(stage, seconds, analysis=None, simulator=None, workers=0,
+               **extra):
+        records.append(dict(network=network, analysis=analysis,
+                            simulator=simulator, workers=workers,
+                            stage=stage, seconds=seconds, **extra))
+        print('{:<12} {:<8} {:<6} {:>3} {:<20} {:>10.3f}'.format(
+              network, analysis or '', simulator or '', workers, stage,
+              seconds))
+
+    wn, seconds = _timed(load)
+    record('load', seconds, nodes=wn.num_nodes, links=wn.num_links)
+    out_dir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        # Baseline simulation, as the pipe and segment analyses run it.
+        for simulator in simulators:
+            _wn = copy.deepcopy(wn)
+            _set_PDD_params(_wn, 17.58, 14.06)
+            _wn.options.time.duration = 86400 + 172800
+            nzd_nodes = _get_nzd_nodes(_wn)
+            (below_pmin, wn_pickle), seconds = _timed(
+                _get_lowP_nodes, _wn, 14.06, nzd_nodes, out_dir,
+                86400 if simulator == 'wntr' else None,
+                simulator=simulator)
+            os.remove(wn_pickle)
+            record('baseline', seconds, simulator=simulator)
+        _, seconds = _timed(cm.inp_to_geojson, wn, to_file=False)
+        record('inp_to_geojson', seconds)
+
+        valve_layer = wntr.network.generate_valve_layer(wn, n=2, seed=123)
+        node_segments, link_segments, _ = wntr.metrics.valve_segments(
+            wn.get_graph(), valve_layer)
+        runs = [(analysis, simulator, workers) for analysis in analyses
+                for simulator in simulators for workers in [0] + worker_counts]
+        for analysis, simulator, workers in runs:
+            run_dir = os.path.join(out_dir, '{}_{}_{}'.format(
+                analysis, simulator, workers))
+            kwargs = dict(output_dir=run_dir, post_process=False,
+                          simulator=simulator)
+            if workers:
+                kwargs['executor'] = cm.LocalExecutor(workers)
+            if analysis == 'fire':
+                results, seconds = _timed(cm.fire_criticality_analysis,
+                                          wn, **kwargs)
+            elif analysis == 'pipe':
+                results, seconds = _timed(cm.pipe_criticality_analysis,
+                                          wn, **kwargs)
+            else:
+                results, seconds = _timed(
+                    cm.segment_criticality_analysis, wn, link_segments,
+                    node_segments, valve_layer, **kwargs)
+            record('analysis', seconds, analysis, simulator, workers,
+                   scenarios=len(results),
+                   scenarios_per_sec=len(results) / seconds)
+            sim = results.metrics['sim_time'].astype(float)
+            if len(sim):
+                record('scenario_sim', float(sim.sum()), analysis,
+                       simulator, workers, mean=float(sim.mean()),
+                       median=float(sim.median()),
+                       p95=float(np.percentile(sim, 95)),
+                       max=float(sim.max()),
+                       solver_iterations=float(
+                           results.metrics['solver_iterations'].mean()))
+            if workers:
+                continue
+            # Output stages, from the serial run.
+            summary_file = os.path.join(run_dir, 'bench_summary.yml')
+
+            def write_summary():
+                with open(summary_file, 'w') as fp:
+                    yaml.dump(results.to_dict(), fp,
+                              default_flow_style=False)
+                results.save(os.path.splitext(summary_file)[0] + '.npz')
+            _, seconds = _timed(write_summary)
+            record('summary_write', seconds, analysis, simulator)
+            segment_kwargs = {}
+            if analysis == 'segment':
+                segment_kwargs = dict(link_segments=link_segments,
+                                      node_segments=node_segments,
+                                      valve_layer=valve_layer)
+            _, seconds = _timed(cm.process_criticality, wn, results,
+                                run_dir, **segment_kwargs)
+            record('process_criticality', seconds, analysis, simulator)
+            if analysis != 'segment':
+                _, seconds = _timed(cm.make_criticality_map, wn,
+                                    results, os.path.join(run_dir,
+                                                          'map.html'))
+                record('map', seconds, analysis, simulator)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def compare(old_file, new_file):
+    """Print the change in each stage time between two benchmark runs."""
+    runs = []
+    for results_file in [old_file, new_file]:
+        with open(results_file, 'r') as fp:
+            runs.append(json.load(fp))
+    # Runs recorded before the simulator option simulated with WNTR.
+    old, new = [{(r['network'], r['analysis'],
+                  r.get('simulator', None if r['stage'] in
+                        ('load', 'inp_to_geojson') else 'wntr'),
+                  r['workers'], r['stage']): r['seconds']
+                 for r in run['records']} for run in runs]
+    print('{} ({}) -> {} ({})'.format(old_file, runs[0]['commit'],
+                                      new_file, runs[1]['commit']))
+    print('{:<12} {:<8} {:<6} {:>3} {:<20} {:>10} {:>10} {:>8}'.format(
+          'network', 'analysis', 'sim', 'n', 'stage', 'old (s)', 'new (s)',
+          'ratio'))
+    for key in [key for key in old if key in new]:
+        network, analysis, simulator, workers, stage = key
+        print('{:<12} {:<8} {:<6} {:>3} {:<20} {:>10.3f} {:>10.3f} {:>8.2f}'
+              .format(network, analysis or '', simulator or '', workers,
+                      stage, old[key], new[key],
+                      new[key] / old[key] if old[key] else float('nan')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time the stages of criticality analyses.')
+    parser.add_argument('--inp', nargs='+', default=[NET3],
+                        help='networks to benchmark (default: Net3)')
+    parser.add_argument('--synthetic', nargs='+', type=int, metavar='N',
+                        help='benchmark synthetic networks of N junctions '
+                             'instead of --inp networks')
+    parser.add_argument('--topology', nargs='+', default=['grid'],
+                        choices=['grid', 'tree', 'mixed'],
+                        help='synthetic network topologies (default: grid)')
+    parser.add_argument('--analyses', nargs='+',
+                        default=['fire', 'pipe', 'segment'],
+                        choices=['fire', 'pipe', 'segment'])
+    parser.add_argument('--simulators', nargs='+', default=['wntr'],
+                        choices=['wntr', 'epanet'],
+                        help='simulators to run the analyses with (default: '
+                             'wntr)')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4],
+                        help='worker process counts to run with, besides '
+                             'serially')
+    parser.add_argument('--output', help='results .json file (default: '
+                        'results/bench_<commit>_<time>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files and exit')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    worker_counts = [n for n in args.workers if n <= mp.cpu_count()]
+    if worker_counts != args.workers:
+        print('skipping worker counts over the', mp.cpu_count(), 'cpus')
+    commit = _commit()
+    records = []
+    if args.synthetic:
+        for topology in args.topology:
+            for n in args.synthetic:
+                # A source per 500 junctions keeps the pressures up.
+                bench_network('{}_{}'.format(topology, n),
+                              partial(synthetic_network, n, topology,
+                                      n_sources=max(1, n // 500), seed=n),
+                              args.analyses, args.simulators, worker_counts,
+                              records)
+    else:
+        for inp_file in args.inp:
+            bench_network(os.path.basename(inp_file),
+                          partial(wntr.network.WaterNetworkModel, inp_file),
+                          args.analyses, args.simulators, worker_counts,
+                          records)
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(BENCH_DIR, 'results'), exist_ok=True)
+        output = os.path.join(BENCH_DIR, 'results', 'bench_{}_{}.json'.format(
+            (commit or 'nocommit')[:8], time.strftime('%Y%m%d-%H%M%S')))
+    with open(output, 'w') as fp:
+        json.dump({'commit': commit,
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'wntr': wntr.__version__,
+                   'criticalityMaps': cm.__version__,
+                   'platform': platform.platform(),
+                   'cpu_count': mp.cpu_count(),
+                   'records': records}, fp, indent=1)
+    print('saved', output)
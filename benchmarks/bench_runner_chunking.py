@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of mp_queue_tools.runner against chunk size.
+
+Runs batches of short busy-wait tasks through the runner with fixed chunk
+sizes and with adaptive chunking (chunk_size=None), and prints the tasks
+completed per second for each. Short tasks are where queue round trips
+dominate, so that is where chunking matters.
+
+Usage: python bench_runner_chunking.py [n_tasks] [num_processors]
+"""
+import sys
+import time
+from criticalityMaps.criticality.mp_queue_tools import runner
+
+
+def _busy(i, task_time):
+    # Spin rather than sleep so the task holds a cpu like a simulation.
+    end = time.perf_counter() + task_time
+    while time.perf_counter() < end:
+        pass
+    return i
+
+
+def _ignore(result):
+    pass
+
+
+def bench(n_tasks, num_processors, task_time, chunk_size):
+    tasks = [(_busy, (i,)) for i in range(n_tasks)]
+    start = time.perf_counter()
+    runner(tasks, num_processors, callback=_ignore,
+           context={'task_time': task_time}, chunk_size=chunk_size)
+    return n_tasks / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    n_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_processors = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    chunk_sizes = [1, 4, 16, 64, None]
+    rows = []
+    for task_time in [0.0001, 0.001, 0.01]:
+        for chunk_size in chunk_sizes:
+            # Keep the slow cases to about the same wall time as the fast ones.
+            n = max(num_processors * 10, int(n_tasks * 0.0001 / task_time))
+            rows.append((task_time, chunk_size,
+                         bench(n, num_processors, task_time, chunk_size)))
+    print()
+    print('{:>12} {:>10} {:>12}'.format('task (ms)', 'chunk', 'tasks/s'))
+    for task_time, chunk_size, throughput in rows:
+        print('{:>12.1f} {:>10} {:>12.0f}'.format(
+              task_time * 1000, 'auto' if chunk_size is None else chunk_size,
+              throughput))
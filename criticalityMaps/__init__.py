@@ -1,4 +1,5 @@
 from criticalityMaps.mapping import inp_to_geojson, make_criticality_map, wn_dataframe
-from criticalityMaps.criticality import fire_criticality_analysis, pipe_criticality_analysis, segment_criticality_analysis, process_criticality, runner
+from criticalityMaps.criticality import fire_criticality_analysis, pipe_criticality_analysis, segment_criticality_analysis, process_criticality, runner, CriticalityResults, LocalExecutor, FuturesExecutor, SocketExecutor, socket_worker
+from criticalityMaps.synthetic import synthetic_network
 
 __version__ = '0.0.2'
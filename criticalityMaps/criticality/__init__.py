@@ -1,2 +1,4 @@
 from .core import fire_criticality_analysis, pipe_criticality_analysis, segment_criticality_analysis, process_criticality
+from .results import CriticalityResults
 from .mp_queue_tools import runner 
+from .executors import LocalExecutor, FuturesExecutor, SocketExecutor, socket_worker
@@ -7,18 +7,30 @@ Created on Tue Jun  4 11:09:02 2019
 Modified: jhogge
 """
 import os
+import json
 import shutil
 import multiprocessing as mp
 import time
 import pickle
 import copy
+import tempfile
+import hashlib
+import itertools
 import matplotlib.pyplot as plt
 import pandas as pd
 import yaml
 import numpy as np
 import wntr
-from .mp_queue_tools import runner
-from .criticality_functions import _fire_criticality, _pipe_criticality, _segment_criticality
+from .executors import LocalExecutor
+from .criticality_functions import _fire_criticality, _pipe_criticality, _segment_criticality, _load_wn, _unload_wn, _run_sim
+from .topology import _screen_closures, _segment_closures
+from .summary import _SummaryColumns, _npz_file
+from .results import CriticalityResults
+from .telemetry import _Telemetry
+from .profiling import _Profiler
+from .schedule import (_fire_costs, _pipe_costs, _segment_costs,
+                       _expected_costs, _load_timings, _save_timings,
+                       _makespan)
 
 
 def fire_criticality_analysis(wn, output_dir="./", fire_demand=0.946,
@@ -27,7 +39,11 @@ def fire_criticality_analysis(wn, output_dir="./", fire_demand=0.946,
                               p_nom=17.58, p_min=14.06, save_log=False,
                               summary_file='fire_criticality_summary.yml',
                               post_process=True, pop=None, multiprocess=False,
-                              num_processors=None):
+                              num_processors=None, checkpoint=True,
+                              baseline_cache=None, resume=False,
+                              binary_summary=True, timeout=None,
+                              retries=1, executor=None, progress=None,
+                              profile=False, simulator='wntr'):
     """
     A plug-and-play ready function for executing fire criticality analysis.
 
@@ -117,6 +133,99 @@ def fire_criticality_analysis(wn, output_dir="./", fire_demand=0.946,
         Defaults to None if mp is False.
         Otherwise, defaults to int(mp.cpu_count() * 0.666), or 2/3 of the
         available processors.
+
+    checkpoint: boolean, optional
+        option to save the baseline hydraulic state at fire_start and start
+        every fire simulation from it, rather than re-simulating the hours
+        before the fire for every node.
+
+        Defaults to True.
+
+    baseline_cache: str/path-like object, optional
+        path to a directory to cache the baseline simulation results in.
+        Repeat analyses of the same network with the same PDD parameters and
+        durations reuse the cached results instead of re-running the
+        baseline simulation. Entries are keyed by the network content, so
+        changes to the network invalidate them.
+
+        Defaults to None (no caching).
+
+    resume: boolean, optional
+        option to resume an interrupted analysis from the .json logs it
+        left in output_dir/log, under the name of its summary file.
+        Scenarios completed by a run with the same network and parameters
+        are not run again and their logged results are merged into the
+        summary. Failed or missing scenarios are run.
+
+        Defaults to False.
+
+    binary_summary: boolean, optional
+        option to also save the results as a columnar .npz summary next to
+        the .yml summary file. process_criticality and make_criticality_map
+        read it in place of the much slower to parse .yml file.
+
+        Defaults to True.
+
+    timeout: int/float, optional
+        wall-clock limit on each scenario in seconds, when multiprocess is
+        True. The worker running a scenario for longer is replaced and the
+        scenario is retried. A scenario still timing out after its retries
+        is recorded in the summary as 'timed out: ...'.
+
+        Defaults to None (no limit).
+
+    retries: int, optional
+        number of times a scenario is run again after timing out or after
+        its worker process dies, when multiprocess is True. A scenario whose
+        worker still dies after its retries is recorded as 'failed: ...'.
+
+        Defaults to 1.
+
+    executor: LocalExecutor, FuturesExecutor or SocketExecutor, optional
+        executor to run the scenarios with, in place of the processes set up
+        by multiprocess, num_processors, timeout and retries. A
+        SocketExecutor runs them on workers that can be on other hosts.
+
+        Defaults to None.
+
+    progress: callable, optional
+        function called with a dict of the progress of the run each time a
+        scenario finishes: 'scenario', 'done', 'total', 'elapsed' (sec),
+        'rate' (scenarios/sec), 'eta' (sec) and the scenario's 'metrics'.
+        The workers then no longer print a line for each chunk they finish.
+
+        Defaults to None.
+
+    profile: boolean or float, optional
+        option to profile the scenario runs with cProfile, in whichever
+        process runs them. True profiles every scenario, a number between 0
+        and 1 profiles about that fraction of them. The merged stats are
+        saved next to the summary file (``*_profile.prof``), with a report
+        of the time spent in each stage of the scenarios
+        (``*_profile.txt``).
+
+        Defaults to False.
+
+    simulator: str, optional
+        hydraulic simulator to run the baseline and scenarios with: 'wntr'
+        (the WNTRSimulator) or 'epanet' (wntr's EpanetSimulator, on the
+        compiled EPANET 2.2 toolkit, in PDD mode). 'epanet' is much faster
+        per scenario, but simulates every scenario from the start, as
+        EPANET cannot resume from the checkpoint. Its pressures agree
+        closely with the WNTRSimulator's, except behind tanks that drain
+        empty, which EPANET keeps supplying.
+
+        Defaults to 'wntr'.
+
+    Returns
+    -------
+    results: CriticalityResults
+        the results of the analysis, which process_criticality and
+        make_criticality_map also accept in place of the summary file. The
+        metrics of each scenario run (worker, load, simulation and
+        post-processing times, solver iterations and failure reason) are in
+        its metrics attribute, and saved next to the summary file
+        (``*_metrics.csv``).
     """
     # Make copy of the wn, preserving the original.
     _wn = copy.deepcopy(wn)
@@ -124,15 +233,13 @@ def fire_criticality_analysis(wn, output_dir="./", fire_demand=0.946,
     start = time.time()
     # Set the PDD simulation characteristics.
     _set_PDD_params(_wn, p_nom, p_min)
+    # Hash the network and parameters to check logged results against.
+    wn_hash = _wn_hash(_wn, output_dir)
+    run_key = _params_key(wn_hash, 'fire', fire_demand, fire_start,
+                          fire_duration, min_pipe_diam, max_pipe_diam, p_nom,
+                          p_min, simulator)
     # Duration can be set in _fire_criticality instead of here
     # _wn.options.time.duration = fire_start + fire_duration
-    # Pickle-serialize the _wn for reuse.
-    with open('./_wn.pickle', 'wb') as fp:
-        pickle.dump(_wn, fp)
-    # Check if any nzd junctions fall below pmin during sim period.
-    nzd_nodes = _get_nzd_nodes(_wn)
-    nodes_below_pmin = _get_lowP_nodes(_wn, p_min, nzd_nodes)
-
     # Define eligible pipes for fire criticality.
     fire_pipes_hi = _wn.query_link_attribute('diameter', np.less_equal,
                                              max_pipe_diam,
@@ -148,41 +255,71 @@ def fire_criticality_analysis(wn, output_dir="./", fire_demand=0.946,
         pipe = _wn.get_link(pipe_name)
         fire_nodes.add(pipe.start_node_name)
         fire_nodes.add(pipe.end_node_name)
+    # Only junctions take a fire demand.
+    fire_nodes &= set(_wn.junction_name_list)
     # Define output files.
-    log_dir = os.path.join(output_dir, 'log', '')
+    log_dir = _log_dir(output_dir, summary_file)
     os.makedirs(log_dir, exist_ok=True)
     summary_file = os.path.join(output_dir, summary_file)
-    if multiprocess:
-        # Define arguments for fire analysis.
-        args = [(_fire_criticality, ('./_wn.pickle', fire_start, fire_duration,
-                                     p_min, p_nom, node, fire_demand,
-                                     nzd_nodes, nodes_below_pmin, log_dir))
-                for node in fire_nodes]
-        # Execute in a mp fashion.
-        mp.freeze_support()
-        results = runner(args, num_processors)
-        with open(summary_file, 'w') as fp:
-            yaml.dump(dict(results), fp, default_flow_style=False)
-        print('fire criticality runtime (sec) =', round(time.time() - start))
-    else:
-        # Define arguments for fire analysis.
-        result = []
-        for node in fire_nodes:
-            result.append(_fire_criticality('./_wn.pickle', fire_start,
-                                            fire_duration, p_min, p_nom, node,
-                                            fire_demand, nzd_nodes,
-                                            nodes_below_pmin, log_dir)
-                          )
-        with open(summary_file, 'w') as fp:
-            yaml.dump(dict(result), fp, default_flow_style=False)
+    timings_file = os.path.splitext(summary_file)[0] + '_timings.json'
+    metrics_file = os.path.splitext(summary_file)[0] + '_metrics.csv'
+    profiler = _Profiler(profile) if profile else None
+    # Check if any nzd junctions fall below pmin during sim period, and
+    # serialize the _wn once for reuse by every scenario of this run.
+    nzd_nodes = _get_nzd_nodes(_wn)
+    # EPANET cannot resume from a checkpoint.
+    checkpoint_time = (fire_start if checkpoint and simulator == 'wntr'
+                       else None)
+    cache_key = _params_key(wn_hash, p_nom, p_min, checkpoint_time,
+                            wntr.__version__, simulator)
+    nodes_below_pmin, wn_pickle = _get_lowP_nodes(_wn, p_min, nzd_nodes,
+                                                  output_dir, checkpoint_time,
+                                                  baseline_cache, cache_key,
+                                                  simulator)
+    try:
+        # Skip the scenarios already completed by an interrupted run.
+        completed = _resume_logs(log_dir, run_key, fire_nodes, resume)
+        fire_nodes = [node for node in fire_nodes if node not in completed]
+        columns = _SummaryColumns()
+        with open(summary_file, 'w') as fp, \
+                open(metrics_file, 'w', newline='') as metrics_fp:
+            # Write the results at hand, then stream in the rest as they
+            # finish.
+            for result in completed.items():
+                _append_summary(fp, columns, result)
+            # Arguments shared by every fire scenario.
+            context = {'wn_pickle': wn_pickle, 'start': fire_start,
+                       'fire_duration': fire_duration, 'p_min': p_min,
+                       'p_nom': p_nom, 'fire_dmnd': fire_demand,
+                       'nzd_nodes': nzd_nodes,
+                       'nodes_below_pmin': nodes_below_pmin,
+                       'simulator': simulator}
+            metrics = _run_scenarios(_fire_criticality,
+                                     [(node,) for node in fire_nodes], context,
+                                     fp, columns, log_dir,
+                                     _get_executor(executor, multiprocess,
+                                                   num_processors, timeout,
+                                                   retries),
+                                     _fire_costs(_wn, fire_nodes),
+                                     timings_file, wn_hash, metrics_fp,
+                                     progress, profiler)
+        results = CriticalityResults.from_summary(columns.to_arrays(), 'fire',
+                                                  metrics)
+        if binary_summary:
+            results.save(_npz_file(summary_file))
+        if profiler is not None:
+            print(profiler.report(os.path.splitext(summary_file)[0], 'fire'))
         print('fire criticality runtime (sec) =', round(time.time() - start))
-    # Clean up temp files
-    os.remove('./_wn.pickle')
+    finally:
+        # Clean up temp files, also if the run fails.
+        os.remove(wn_pickle)
+        _unload_wn(wn_pickle)
     if not save_log:
-        shutil.rmtree(log_dir)
+        _remove_log_dir(log_dir)
     # Process the results and save some data and figures.
     if post_process:
-        process_criticality(_wn, summary_file, output_dir, pop)
+        process_criticality(_wn, results, output_dir, pop)
+    return results
 
 
 def pipe_criticality_analysis(wn, output_dir="./", break_start=86400,
@@ -191,7 +328,12 @@ def pipe_criticality_analysis(wn, output_dir="./", break_start=86400,
                               save_log=False,
                               summary_file='pipe_criticality_summary.yml',
                               post_process=True, pop=None, multiprocess=False,
-                              num_processors=None):
+                              num_processors=None, screen_topology=False,
+                              checkpoint=True, baseline_cache=None,
+                              resume=False, binary_summary=True,
+                              timeout=None, retries=1, executor=None,
+                              progress=None, profile=False,
+                              simulator='wntr', early_stop=None):
     """
     A plug-and-play ready function for executing fire criticality analysis.
 
@@ -276,7 +418,124 @@ def pipe_criticality_analysis(wn, output_dir="./", break_start=86400,
         Defaults to None if mp is False.
         Otherwise, defaults to int(mp.cpu_count() * 0.666), or 2/3 of the
         available processors.
+
+    screen_topology: boolean, optional
+        option to resolve pipe closures that only cut a part of the network
+        without tanks or reservoirs off from the rest of the system straight
+        from the network connectivity, without a simulation. Nzd nodes in
+        the cut off part are reported at 0 pressure. Assumes the rest of the
+        system is not harmed by losing the demand of the cut off part.
+
+        Defaults to False.
+
+    checkpoint: boolean, optional
+        option to save the baseline hydraulic state at break_start and start
+        every closure simulation from it, rather than re-simulating the
+        hours before the break for every closure.
+
+        Defaults to True.
+
+    baseline_cache: str/path-like object, optional
+        path to a directory to cache the baseline simulation results in.
+        Repeat analyses of the same network with the same PDD parameters and
+        durations reuse the cached results instead of re-running the
+        baseline simulation. Entries are keyed by the network content, so
+        changes to the network invalidate them.
+
+        Defaults to None (no caching).
+
+    resume: boolean, optional
+        option to resume an interrupted analysis from the .json logs it
+        left in output_dir/log, under the name of its summary file.
+        Scenarios completed by a run with the same network and parameters
+        are not run again and their logged results are merged into the
+        summary. Failed or missing scenarios are run.
+
+        Defaults to False.
+
+    binary_summary: boolean, optional
+        option to also save the results as a columnar .npz summary next to
+        the .yml summary file. process_criticality and make_criticality_map
+        read it in place of the much slower to parse .yml file.
+
+        Defaults to True.
+
+    timeout: int/float, optional
+        wall-clock limit on each scenario in seconds, when multiprocess is
+        True. The worker running a scenario for longer is replaced and the
+        scenario is retried. A scenario still timing out after its retries
+        is recorded in the summary as 'timed out: ...'.
+
+        Defaults to None (no limit).
+
+    retries: int, optional
+        number of times a scenario is run again after timing out or after
+        its worker process dies, when multiprocess is True. A scenario whose
+        worker still dies after its retries is recorded as 'failed: ...'.
+
+        Defaults to 1.
+
+    executor: LocalExecutor, FuturesExecutor or SocketExecutor, optional
+        executor to run the scenarios with, in place of the processes set up
+        by multiprocess, num_processors, timeout and retries. A
+        SocketExecutor runs them on workers that can be on other hosts.
+
+        Defaults to None.
+
+    progress: callable, optional
+        function called with a dict of the progress of the run each time a
+        scenario finishes: 'scenario', 'done', 'total', 'elapsed' (sec),
+        'rate' (scenarios/sec), 'eta' (sec) and the scenario's 'metrics'.
+        The workers then no longer print a line for each chunk they finish.
+
+        Defaults to None.
+
+    profile: boolean or float, optional
+        option to profile the scenario runs with cProfile, in whichever
+        process runs them. True profiles every scenario, a number between 0
+        and 1 profiles about that fraction of them. The merged stats are
+        saved next to the summary file (``*_profile.prof``), with a report
+        of the time spent in each stage of the scenarios
+        (``*_profile.txt``).
+
+        Defaults to False.
+
+    simulator: str, optional
+        hydraulic simulator to run the baseline and scenarios with: 'wntr'
+        (the WNTRSimulator) or 'epanet' (wntr's EpanetSimulator, on the
+        compiled EPANET 2.2 toolkit, in PDD mode). 'epanet' is much faster
+        per scenario, but simulates every scenario from the start, as
+        EPANET cannot resume from the checkpoint. Its pressures agree
+        closely with the WNTRSimulator's, except behind tanks that drain
+        empty, which EPANET keeps supplying.
+
+        Defaults to 'wntr'.
+
+    early_stop: float, optional
+        option to stop simulating a break once the network repeats its
+        daily cycle: when every pressure at the end of a day of the break
+        is within early_stop (m) of the pressure a day before. The rest of
+        the break would not find lower pressures, provided the demand
+        patterns and controls repeat daily. The break is simulated a day at
+        a time to check, and the time each scenario was cut short at is
+        noted in the summary file and in the metrics (stopped_at). Needs the
+        WNTRSimulator, which resumes each day where the last one ended.
+
+        Defaults to None (simulate the whole break).
+
+    Returns
+    -------
+    results: CriticalityResults
+        the results of the analysis, which process_criticality and
+        make_criticality_map also accept in place of the summary file. The
+        metrics of each scenario run (worker, load, simulation and
+        post-processing times, solver iterations and failure reason) are in
+        its metrics attribute, and saved next to the summary file
+        (``*_metrics.csv``).
     """
+    if early_stop is not None and simulator == 'epanet':
+        raise ValueError("early_stop needs simulator='wntr', as EPANET "
+                         "would simulate each break from the start every day")
     # Make copy of the wn, preserving the original.
     _wn = copy.deepcopy(wn)
     # Start the timer.
@@ -284,13 +543,11 @@ def pipe_criticality_analysis(wn, output_dir="./", break_start=86400,
     # Set the PDD simulation characteristics.
     _set_PDD_params(_wn, p_nom, p_min)
     _wn.options.time.duration = break_start + break_duration
-    # Pickle-serialize the _wn for reuse.
-    with open('./_wn.pickle', 'wb') as fp:
-        pickle.dump(_wn, fp)
-    # Check if any nzd junctions fall below pmin during sim period.
-    nzd_nodes = _get_nzd_nodes(_wn)
-    nodes_below_pmin = _get_lowP_nodes(_wn, p_min, nzd_nodes)
-
+    # Hash the network and parameters to check logged results against.
+    wn_hash = _wn_hash(_wn, output_dir)
+    run_key = _params_key(wn_hash, 'pipe', break_start, break_duration,
+                          min_pipe_diam, max_pipe_diam, p_nom, p_min,
+                          screen_topology, simulator, early_stop)
     # Define eligible pipes for pipe criticality.
     critical_pipes_lo = _wn.query_link_attribute('diameter', np.greater_equal,
                                                  min_pipe_diam,
@@ -304,41 +561,80 @@ def pipe_criticality_analysis(wn, output_dir="./", break_start=86400,
     else:
         critical_pipes = list(set(critical_pipes_lo.index))
     # Define output files.
-    log_dir = os.path.join(output_dir, 'log', '')
+    log_dir = _log_dir(output_dir, summary_file)
     os.makedirs(log_dir, exist_ok=True)
     summary_file = os.path.join(output_dir, summary_file)
-    # run the simulations
-    if multiprocess:
-        # Define arguments for pipe analysis.
-        args = [(_pipe_criticality, ('./_wn.pickle', break_start,
-                                     break_duration, p_min, p_nom, pipe,
-                                     nzd_nodes, nodes_below_pmin, log_dir))
-                for pipe in critical_pipes]
-        # Execute in a mp fashion.
-        mp.freeze_support()
-        results = runner(args, num_processors)
-        with open(summary_file, 'w') as fp:
-            yaml.dump(dict(results), fp, default_flow_style=False)
-        print('pipe criticality runtime (sec) =', round(time.time() - start))
-    else:
-        # Define arguments for fire analysis.
-        result = []
-        for pipe in critical_pipes:
-            result.append(_pipe_criticality('./_wn.pickle', break_start,
-                                            break_duration, p_min, p_nom, pipe,
-                                            nzd_nodes, nodes_below_pmin,
-                                            log_dir)
-                          )
-        with open(summary_file, 'w') as fp:
-            yaml.dump(dict(result), fp, default_flow_style=False)
+    timings_file = os.path.splitext(summary_file)[0] + '_timings.json'
+    metrics_file = os.path.splitext(summary_file)[0] + '_metrics.csv'
+    profiler = _Profiler(profile) if profile else None
+    # Check if any nzd junctions fall below pmin during sim period, and
+    # serialize the _wn once for reuse by every scenario of this run.
+    nzd_nodes = _get_nzd_nodes(_wn)
+    # EPANET cannot resume from a checkpoint.
+    checkpoint_time = (break_start if checkpoint and simulator == 'wntr'
+                       else None)
+    cache_key = _params_key(wn_hash, p_nom, p_min, checkpoint_time,
+                            wntr.__version__, simulator)
+    nodes_below_pmin, wn_pickle = _get_lowP_nodes(_wn, p_min, nzd_nodes,
+                                                  output_dir, checkpoint_time,
+                                                  baseline_cache, cache_key,
+                                                  simulator)
+    try:
+        # Skip the scenarios already completed by an interrupted run.
+        completed = _resume_logs(log_dir, run_key, critical_pipes, resume)
+        critical_pipes = [pipe for pipe in critical_pipes
+                          if pipe not in completed]
+        # Resolve the closures that only cut off sourceless parts of the
+        # network.
+        screened = {}
+        if screen_topology:
+            closures = {pipe: [pipe] for pipe in critical_pipes}
+            screened = _screen_closures(_wn, closures, nzd_nodes,
+                                        nodes_below_pmin, break_start,
+                                        _wn.options.time.duration)
+            _log_screened(screened, log_dir)
+            critical_pipes = [pipe for pipe in critical_pipes
+                              if pipe not in screened]
+        # run the simulations
+        columns = _SummaryColumns()
+        with open(summary_file, 'w') as fp, \
+                open(metrics_file, 'w', newline='') as metrics_fp:
+            # Write the results at hand, then stream in the rest as they
+            # finish.
+            for result in itertools.chain(completed.items(), screened.items()):
+                _append_summary(fp, columns, result)
+            # Arguments shared by every pipe scenario.
+            context = {'wn_pickle': wn_pickle, 'start': break_start,
+                       'break_duration': break_duration, 'p_min': p_min,
+                       'p_nom': p_nom, 'nzd_nodes': nzd_nodes,
+                       'nodes_below_pmin': nodes_below_pmin,
+                       'simulator': simulator, 'early_stop': early_stop}
+            metrics = _run_scenarios(_pipe_criticality,
+                                     [(pipe,) for pipe in critical_pipes],
+                                     context, fp, columns, log_dir,
+                                     _get_executor(executor, multiprocess,
+                                                   num_processors, timeout,
+                                                   retries),
+                                     _pipe_costs(_wn, critical_pipes),
+                                     timings_file, wn_hash, metrics_fp,
+                                     progress, profiler)
+        results = CriticalityResults.from_summary(columns.to_arrays(), 'pipe',
+                                                  metrics)
+        if binary_summary:
+            results.save(_npz_file(summary_file))
+        if profiler is not None:
+            print(profiler.report(os.path.splitext(summary_file)[0], 'pipe'))
         print('pipe criticality runtime (sec) =', round(time.time() - start))
-    # Clean up temp files.
-    os.remove('./_wn.pickle')
+    finally:
+        # Clean up temp files, also if the run fails.
+        os.remove(wn_pickle)
+        _unload_wn(wn_pickle)
     if not save_log:
-        shutil.rmtree(log_dir)
+        _remove_log_dir(log_dir)
     # Process the results and save some data and figures.
     if post_process:
-        process_criticality(_wn, summary_file, output_dir, pop)
+        process_criticality(_wn, results, output_dir, pop)
+    return results
 
 
 def segment_criticality_analysis(wn, link_segments, node_segments, valve_layer, 
@@ -348,7 +644,12 @@ def segment_criticality_analysis(wn, link_segments, node_segments, valve_layer,
                                  save_log=False,
                                  summary_file='segment_criticality_summary.yml',
                                  post_process=True, pop=None, multiprocess=False,
-                                 num_processors=None):
+                                 num_processors=None, screen_topology=False,
+                                 checkpoint=True, baseline_cache=None,
+                                 resume=False, binary_summary=True,
+                                 timeout=None, retries=1, executor=None,
+                                 progress=None, profile=False,
+                                 simulator='wntr', early_stop=None):
     """
     A plug-and-play ready function for executing segment criticality analysis.
 
@@ -442,7 +743,124 @@ def segment_criticality_analysis(wn, link_segments, node_segments, valve_layer,
         Defaults to None if mp is False.
         Otherwise, defaults to int(mp.cpu_count() * 0.666), or 2/3 of the
         available processors.
+
+    screen_topology: boolean, optional
+        option to resolve segment closures that only cut a part of the network
+        without tanks or reservoirs off from the rest of the system straight
+        from the network connectivity, without a simulation. Nzd nodes in
+        the cut off part are reported at 0 pressure. Assumes the rest of the
+        system is not harmed by losing the demand of the cut off part.
+
+        Defaults to False.
+
+    checkpoint: boolean, optional
+        option to save the baseline hydraulic state at break_start and start
+        every closure simulation from it, rather than re-simulating the
+        hours before the break for every closure.
+
+        Defaults to True.
+
+    baseline_cache: str/path-like object, optional
+        path to a directory to cache the baseline simulation results in.
+        Repeat analyses of the same network with the same PDD parameters and
+        durations reuse the cached results instead of re-running the
+        baseline simulation. Entries are keyed by the network content, so
+        changes to the network invalidate them.
+
+        Defaults to None (no caching).
+
+    resume: boolean, optional
+        option to resume an interrupted analysis from the .json logs it
+        left in output_dir/log, under the name of its summary file.
+        Scenarios completed by a run with the same network and parameters
+        are not run again and their logged results are merged into the
+        summary. Failed or missing scenarios are run.
+
+        Defaults to False.
+
+    binary_summary: boolean, optional
+        option to also save the results as a columnar .npz summary next to
+        the .yml summary file. process_criticality and make_criticality_map
+        read it in place of the much slower to parse .yml file.
+
+        Defaults to True.
+
+    timeout: int/float, optional
+        wall-clock limit on each scenario in seconds, when multiprocess is
+        True. The worker running a scenario for longer is replaced and the
+        scenario is retried. A scenario still timing out after its retries
+        is recorded in the summary as 'timed out: ...'.
+
+        Defaults to None (no limit).
+
+    retries: int, optional
+        number of times a scenario is run again after timing out or after
+        its worker process dies, when multiprocess is True. A scenario whose
+        worker still dies after its retries is recorded as 'failed: ...'.
+
+        Defaults to 1.
+
+    executor: LocalExecutor, FuturesExecutor or SocketExecutor, optional
+        executor to run the scenarios with, in place of the processes set up
+        by multiprocess, num_processors, timeout and retries. A
+        SocketExecutor runs them on workers that can be on other hosts.
+
+        Defaults to None.
+
+    progress: callable, optional
+        function called with a dict of the progress of the run each time a
+        scenario finishes: 'scenario', 'done', 'total', 'elapsed' (sec),
+        'rate' (scenarios/sec), 'eta' (sec) and the scenario's 'metrics'.
+        The workers then no longer print a line for each chunk they finish.
+
+        Defaults to None.
+
+    profile: boolean or float, optional
+        option to profile the scenario runs with cProfile, in whichever
+        process runs them. True profiles every scenario, a number between 0
+        and 1 profiles about that fraction of them. The merged stats are
+        saved next to the summary file (``*_profile.prof``), with a report
+        of the time spent in each stage of the scenarios
+        (``*_profile.txt``).
+
+        Defaults to False.
+
+    simulator: str, optional
+        hydraulic simulator to run the baseline and scenarios with: 'wntr'
+        (the WNTRSimulator) or 'epanet' (wntr's EpanetSimulator, on the
+        compiled EPANET 2.2 toolkit, in PDD mode). 'epanet' is much faster
+        per scenario, but simulates every scenario from the start, as
+        EPANET cannot resume from the checkpoint. Its pressures agree
+        closely with the WNTRSimulator's, except behind tanks that drain
+        empty, which EPANET keeps supplying.
+
+        Defaults to 'wntr'.
+
+    early_stop: float, optional
+        option to stop simulating a break once the network repeats its
+        daily cycle: when every pressure at the end of a day of the break
+        is within early_stop (m) of the pressure a day before. The rest of
+        the break would not find lower pressures, provided the demand
+        patterns and controls repeat daily. The break is simulated a day at
+        a time to check, and the time each scenario was cut short at is
+        noted in the summary file and in the metrics (stopped_at). Needs the
+        WNTRSimulator, which resumes each day where the last one ended.
+
+        Defaults to None (simulate the whole break).
+
+    Returns
+    -------
+    results: CriticalityResults
+        the results of the analysis, which process_criticality and
+        make_criticality_map also accept in place of the summary file. The
+        metrics of each scenario run (worker, load, simulation and
+        post-processing times, solver iterations and failure reason) are in
+        its metrics attribute, and saved next to the summary file
+        (``*_metrics.csv``).
     """
+    if early_stop is not None and simulator == 'epanet':
+        raise ValueError("early_stop needs simulator='wntr', as EPANET "
+                         "would simulate each break from the start every day")
     # Make copy of the wn, preserving the original.
     _wn = copy.deepcopy(wn)
     # Start the timer.
@@ -450,57 +868,99 @@ def segment_criticality_analysis(wn, link_segments, node_segments, valve_layer,
     # Set the PDD simulation characteristics.
     _set_PDD_params(_wn, p_nom, p_min)
     _wn.options.time.duration = break_start + break_duration
-    # Pickle-serialize the _wn for reuse.
-    with open('./_wn.pickle', 'wb') as fp:
-        pickle.dump(_wn, fp)
-    # Check if any nzd junctions fall below pmin during sim period.
-    nzd_nodes = _get_nzd_nodes(_wn)
-    nodes_below_pmin = _get_lowP_nodes(_wn, p_min, nzd_nodes)
-
+    # Hash the network and parameters to check logged results against.
+    wn_hash = _wn_hash(_wn, output_dir)
+    run_key = _params_key(wn_hash, 'segment', break_start, break_duration,
+                          p_nom, p_min, link_segments.to_dict(),
+                          node_segments.to_dict(), screen_topology, simulator,
+                          early_stop)
     # Define output files.
-    log_dir = os.path.join(output_dir, 'log', '')
+    log_dir = _log_dir(output_dir, summary_file)
     os.makedirs(log_dir, exist_ok=True)
     summary_file = os.path.join(output_dir, summary_file)
+    timings_file = os.path.splitext(summary_file)[0] + '_timings.json'
+    metrics_file = os.path.splitext(summary_file)[0] + '_metrics.csv'
+    profiler = _Profiler(profile) if profile else None
     n_segments = np.array([node_segments.max(), link_segments.max()]).max()
-    # run the simulations
-    if multiprocess:
-        # Define arguments for pipe analysis.
-        args = [(_segment_criticality, ('./_wn.pickle', segment,
-                                        link_segments, node_segments,
-                                        nodes_below_pmin, nzd_nodes,
-                                        log_dir, break_start, break_duration, 
-                                        p_min, p_nom)
-                )
-                for segment in np.arange(n_segments)]
-        # Execute in a mp fashion.
-        mp.freeze_support()
-        results = runner(args, num_processors)
-        with open(summary_file, 'w') as fp:
-            yaml.dump(dict(results), fp, default_flow_style=False)
-        print('segment criticality runtime (sec) =', round(time.time() - start))
-    else:
-        # Define arguments for segment analysis.
-        result = []
-        for segment in range(n_segments):
-            result.append(_segment_criticality('./_wn.pickle', segment,
-                                               link_segments, node_segments,
-                                               nodes_below_pmin, nzd_nodes,
-                                               log_dir, break_start, 
-                                               break_duration, p_min, p_nom)
-                          )
-        with open(summary_file, 'w') as fp:
-            yaml.dump(dict(result), fp, default_flow_style=False)
-        print('segment criticality runtime (sec) =', round(time.time() - start))
-    # Clean up temp files.
-    os.remove('./_wn.pickle')
+    segments = list(range(n_segments))
+    # Check if any nzd junctions fall below pmin during sim period, and
+    # serialize the _wn once for reuse by every scenario of this run.
+    nzd_nodes = _get_nzd_nodes(_wn)
+    # EPANET cannot resume from a checkpoint.
+    checkpoint_time = (break_start if checkpoint and simulator == 'wntr'
+                       else None)
+    cache_key = _params_key(wn_hash, p_nom, p_min, checkpoint_time,
+                            wntr.__version__, simulator)
+    nodes_below_pmin, wn_pickle = _get_lowP_nodes(_wn, p_min, nzd_nodes,
+                                                  output_dir, checkpoint_time,
+                                                  baseline_cache, cache_key,
+                                                  simulator)
+    try:
+        # Skip the scenarios already completed by an interrupted run.
+        completed = _resume_logs(log_dir, run_key, segments, resume)
+        segments = [segment for segment in segments
+                    if segment not in completed]
+        # Index the links closed to isolate each segment.
+        closures = _segment_closures(_wn.get_graph(), link_segments,
+                                     node_segments, segments)
+        # Resolve the closures that only cut off sourceless parts of the
+        # network.
+        screened = {}
+        if screen_topology:
+            screened = _screen_closures(_wn, closures, nzd_nodes,
+                                        nodes_below_pmin, break_start,
+                                        _wn.options.time.duration)
+            _log_screened(screened, log_dir)
+            segments = [segment for segment in segments
+                        if segment not in screened]
+        # run the simulations
+        columns = _SummaryColumns()
+        with open(summary_file, 'w') as fp, \
+                open(metrics_file, 'w', newline='') as metrics_fp:
+            # Write the results at hand, then stream in the rest as they
+            # finish.
+            for result in itertools.chain(completed.items(), screened.items()):
+                _append_summary(fp, columns, result)
+            # Arguments shared by every segment scenario.
+            context = {'wn_pickle': wn_pickle,
+                       'nodes_below_pmin': nodes_below_pmin,
+                       'nzd_nodes': nzd_nodes,
+                       'start': break_start, 'break_duration': break_duration,
+                       'p_min': p_min, 'p_nom': p_nom, 'simulator': simulator,
+                       'early_stop': early_stop}
+            metrics = _run_scenarios(_segment_criticality,
+                                     [(segment, closures[segment])
+                                      for segment in segments],
+                                     context, fp, columns, log_dir,
+                                     _get_executor(executor, multiprocess,
+                                                   num_processors, timeout,
+                                                   retries),
+                                     _segment_costs({segment: closures[segment]
+                                                     for segment in segments}),
+                                     timings_file, wn_hash, metrics_fp,
+                                     progress, profiler)
+        results = CriticalityResults.from_summary(columns.to_arrays(),
+                                                  'segment', metrics)
+        if binary_summary:
+            results.save(_npz_file(summary_file))
+        if profiler is not None:
+            print(profiler.report(os.path.splitext(summary_file)[0],
+                                  'segment'))
+        print('segment criticality runtime (sec) =',
+              round(time.time() - start))
+    finally:
+        # Clean up temp files, also if the run fails.
+        os.remove(wn_pickle)
+        _unload_wn(wn_pickle)
     if not save_log:
-        shutil.rmtree(log_dir)
+        _remove_log_dir(log_dir)
     # Process the results and save some data and figures.
     if post_process:
-        process_criticality(_wn, summary_file, output_dir, pop, 
+        process_criticality(_wn, results, output_dir, pop, 
                             link_segments=link_segments, 
                             node_segments=node_segments, 
                             valve_layer=valve_layer)
+    return results
 
 
 def process_criticality(wn, summary_file, output_dir, pop=None,
@@ -514,8 +974,10 @@ def process_criticality(wn, summary_file, output_dir, pop=None,
     wn: wntr WaterNetworkModel object
         the _wn that the analysis was performed on
 
-    summary_file: str/path-like object
-        path to the .yml summary file produced from a criticality analysis
+    summary_file: str/path-like object or CriticalityResults
+        results returned by a criticality analysis, or the path to the .yml or
+        .npz summary file it produced. A .npz summary saved next to the .yml
+        file is read in its place.
 
     pop: dict or pandas Series, optional
         population estimate at each junction of the _wn. Output from
@@ -531,8 +993,7 @@ def process_criticality(wn, summary_file, output_dir, pop=None,
 
     """
     # Set some local parameters.
-    cmap = wntr.graphics.color.custom_colormap(numcolors=2,
-                                               colors=['gray', 'gray'],
+    cmap = wntr.graphics.color.custom_colormap(2, colors=['gray', 'gray'],
                                                name='custom')
     fig_x = 6
     fig_y = 6
@@ -542,34 +1003,23 @@ def process_criticality(wn, summary_file, output_dir, pop=None,
     if pop is None:
         pop = wntr.metrics.population(wn)
     # Parse the results file into nodes and population impacted.
-    with open(summary_file, 'r') as fp:
-        summary = yaml.load(fp, Loader=yaml.BaseLoader)
-    summary_len = pd.Series()
-    summary_pop = pd.Series()
-    failed_sim = {}
-    for key, val in summary.items():
-        if type(val) is dict:
-            summary_len[key] = len(val.keys())
-            summary_pop[key] = 0
-            for node in val.keys():
-                summary_pop[key] += pop[node]
-        elif val == 'NO AFFECTED NODES':
-            pass
-        elif 'failed:' in val:
-            failed_sim[key] = val     
+    if isinstance(summary_file, CriticalityResults):
+        results = summary_file
+    else:
+        results = CriticalityResults.load(summary_file)
+    summary_len = results.nodes_impacted()
+    summary_pop = results.population_impacted(pop)
 
     # assign results from the segments to the links
-    if 'segment' in summary_file:
-        link_nodes_affected = {}
-        link_pop = {}
-        for link in link_segments.index:
-            if str(link_segments[link]) in summary_len.index:
-                link_nodes_affected[link] = summary_len[summary_len.index == str(link_segments[link])][0]
-                link_pop[link] = summary_pop[summary_pop.index == str(link_segments[link])][0]
-            else:
-                link_nodes_affected[link] = 0
-                link_pop[link] = 0
-            
+    if results.analysis == 'segment':
+        link_segment_ids = link_segments.astype(str).values
+        link_nodes_affected = dict(zip(
+                link_segments.index,
+                summary_len.reindex(link_segment_ids, fill_value=0).values))
+        link_pop = dict(zip(
+                link_segments.index,
+                summary_pop.reindex(link_segment_ids, fill_value=0).values))
+
     # Produce output and save in output dir
     if save_csv:
         csv_summary = pd.DataFrame({"Nodes Impacted": summary_len,
@@ -577,8 +1027,12 @@ def process_criticality(wn, summary_file, output_dir, pop=None,
         csv_summary.index.name = "ID"
         csv_summary.to_csv(os.path.join(output_dir, 'pop_node_impacts.csv'))
 
+    if save_maps and summary_len.empty:
+        # Nothing to color the maps with.
+        print('No nodes impacted in any scenario, skipping the maps')
+        save_maps = False
     if save_maps:
-        if 'fire' in summary_file:
+        if results.analysis == 'fire':
             fig, ax = plt.subplots(1, 1, figsize=(fig_x, fig_y))
             wntr.graphics.plot_network(wn, link_attribute='length',
                                        node_size=0, link_cmap=cmap,
@@ -598,7 +1052,7 @@ pressure conditions\nfor each fire demand', ax=ax)
                                        title='Number of people impacted by low\
  pressure conditions\nfor each fire demand', ax=ax)
             plt.savefig(os.path.join(output_dir, 'pop_impacted_map.pdf'))
-        if 'segment' in summary_file:
+        elif results.analysis == 'segment':
             fig, ax = plt.subplots(1, 1, figsize=(fig_x, fig_y))
             wntr.graphics.plot_network(wn, link_attribute='length',
                                        node_size=0, link_cmap=cmap,
@@ -640,11 +1094,175 @@ pressure conditions\nfor each pipe closure', ax=ax)
 
 
 def _set_PDD_params(_wn, pnom, pmin):
-    for name, node in _wn.nodes():
-        node.nominal_pressure = pnom
+    # The EPANET simulator takes the network wide PDD parameters, the
+    # WNTRSimulator those of each junction.
+    _wn.options.hydraulic.demand_model = 'PDD'
+    _wn.options.hydraulic.required_pressure = pnom
+    _wn.options.hydraulic.minimum_pressure = pmin
+    for name, node in _wn.junctions():
+        node.required_pressure = pnom
         node.minimum_pressure = pmin
 
 
+def _serialize_wn(_wn, output_dir):
+    """
+    Pickle the prepared _wn to a temp file that is unique to this run, so
+    analyses sharing a working or output directory do not collide.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    fd, wn_pickle = tempfile.mkstemp(prefix='_wn_', suffix='.pickle',
+                                     dir=output_dir)
+    with os.fdopen(fd, 'wb') as fp:
+        pickle.dump(_wn, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    return wn_pickle
+
+
+def _append_summary(fp, columns, result):
+    """
+    Append one (key, result) entry to the open .yml summary file and flush
+    it, so the summary holds every finished scenario while a run goes on.
+    The entry is also added to the columnar summary, if one is kept.
+    """
+    key, val = result
+    yaml.dump({key: val}, fp, default_flow_style=False)
+    fp.flush()
+    if columns is not None:
+        columns.append(result)
+
+
+def _get_executor(executor, multiprocess, num_processors, timeout, retries):
+    """
+    Get the executor to run the scenarios with: the one given, local worker
+    processes if multiprocess, or None to run them serially.
+    """
+    if executor is None and multiprocess:
+        executor = LocalExecutor(num_processors, timeout=timeout,
+                                 retries=retries)
+    return executor
+
+
+def _run_scenarios(worker, tasks, context, fp, columns, log_dir, executor,
+                   estimates, timings_file, wn_hash, metrics_fp,
+                   progress=None, profiler=None):
+    """
+    Run worker on each of the tasks, [(scenario, arg1, ..., argN)], serially
+    or with the executor, and log and append each result to the summary as
+    it finishes. The metrics of each scenario are written to metrics_fp and
+    returned as a DataFrame, and the progress of the run is reported to
+    progress. The scenarios chosen by profiler are profiled.
+
+    With an executor, the scenarios expected to take longest are run first.
+    The expected cost of a scenario is its run time in an earlier run of the
+    same network, saved in timings_file, or else its cost estimate from
+    estimates. The run times of this run are added to timings_file.
+    """
+    timings = _load_timings(timings_file, wn_hash)
+    telemetry = _Telemetry(metrics_fp, len(tasks), progress)
+    funcs = [worker if profiler is None else profiler.wrap(worker, i)
+             for i in range(len(tasks))]
+    run_times = {}
+    if executor is not None:
+        expected = _expected_costs(estimates, timings)
+        costs = [expected[str(args[0])] for args in tasks]
+        task_times = {}
+        # Execute in a mp fashion.
+        mp.freeze_support()
+        runner_start = time.time()
+        executor.run(list(zip(funcs, tasks)),
+                     lambda result: _finish_scenario(fp, columns, log_dir,
+                                                     telemetry, profiler,
+                                                     result),
+                     initializer=_load_wn,
+                     initargs=(context['wn_pickle'], context['p_nom']),
+                     context=context, failed_result=_failed_result,
+                     costs=costs, timings=task_times,
+                     files=[context['wn_pickle']],
+                     verbose=progress is None)
+        runner_time = time.time() - runner_start
+        run_times = {str(tasks[i][0]): task_time
+                     for i, task_time in task_times.items()}
+        # Compare the makespan of the run order to that of the submission
+        # order, from the run times of this run.
+        num_workers = max(1, executor.num_workers)
+        in_order = [task_times.get(i, 0.0) for i in range(len(tasks))]
+        longest_first = [task_times.get(i, 0.0) for i in
+                         sorted(range(len(tasks)), key=lambda i: costs[i],
+                                reverse=True)]
+        print('makespan (sec) =', round(runner_time, 1),
+              '| with', num_workers, 'workers, the scenario run times '
+              'give', round(_makespan(longest_first, num_workers), 1),
+              'longest expected first vs',
+              round(_makespan(in_order, num_workers), 1),
+              'in submission order')
+    else:
+        for func, args in zip(funcs, tasks):
+            task_start = time.time()
+            result = func(*args, **context)
+            run_times[str(args[0])] = time.time() - task_start
+            _finish_scenario(fp, columns, log_dir, telemetry, profiler,
+                             result)
+    timings.update(run_times)
+    _save_timings(timings_file, wn_hash, timings)
+    return telemetry.to_frame()
+
+
+def _finish_scenario(fp, columns, log_dir, telemetry, profiler, result):
+    # Log the result of a scenario, for resuming, add it to the summary and
+    # record its metrics. The workers return their results rather than
+    # logging them, as they may run on hosts without access to log_dir.
+    key, val, metrics = result
+    write_start = time.time()
+    _log_result(log_dir, (key, val))
+    if metrics.get('stopped_at'):
+        # Note it in a comment, so the summary loads as before.
+        fp.write('# {}: stopped early at {} s, repeating its daily '
+                 'pressures\n'.format(key, metrics['stopped_at']))
+    _append_summary(fp, columns, (key, val))
+    if profiler is not None:
+        profiler.write_time += time.time() - write_start
+        profiler.add(metrics)
+    telemetry.record(key, metrics)
+
+
+def _failed_result(task, reason):
+    # Result of a scenario the executor gave up on, keyed like the worker
+    # functions key theirs.
+    func, args = task
+    return (args[0], reason, {'failure': reason})
+
+
+def _log_dir(output_dir, summary_file):
+    """
+    Get the directory to log the scenario results of a run in, under
+    output_dir/log and named after its summary file, so analyses sharing an
+    output_dir keep their logs apart.
+    """
+    name = os.path.splitext(os.path.basename(summary_file))[0]
+    return os.path.join(output_dir, 'log', name, '')
+
+
+def _remove_log_dir(log_dir):
+    # Remove the logs of a run, and output_dir/log once no other run logs
+    # in it.
+    shutil.rmtree(log_dir)
+    try:
+        os.rmdir(os.path.dirname(os.path.dirname(log_dir)))
+    except OSError:
+        pass
+
+
+def _log_result(log_dir, result):
+    key, val = result
+    with open(log_dir + str(key) + '.json', 'w') as fp:
+        json.dump(val, fp)
+
+
+def _log_screened(screened, log_dir):
+    # Log the screened scenarios like the run ones.
+    for result in screened.items():
+        _log_result(log_dir, result)
+
+
 def _get_nzd_nodes(_wn):
     nzd_nodes = []
     for name, node in _wn.junctions():
@@ -655,16 +1273,145 @@ def _get_nzd_nodes(_wn):
     return nzd_nodes
 
 
-def _get_lowP_nodes(_wn, pmin, nzd_nodes):
-    nodes_below_pmin = {}
+def _get_lowP_nodes(_wn, pmin, nzd_nodes, output_dir, checkpoint_time=None,
+                    cache_dir=None, cache_key=None, simulator='wntr'):
+    """
+    Run the baseline simulation and get the nzd nodes below pmin at each
+    report time, as a boolean DataFrame indexed by report time with a column
+    for each nzd node.
+
+    The _wn is serialized for the scenarios to start from. If checkpoint_time
+    is given, the simulation is paused at the last hydraulic timestep before
+    it and the _wn is serialized in that state, so the scenarios resume from
+    the baseline instead of re-simulating everything before the event.
+    Otherwise the _wn is serialized before the simulation.
+
+    If cache_dir is given, the results and the serialized _wn are looked up
+    in and saved to it under cache_key.
+
+    The simulations are run with simulator, 'wntr' or 'epanet', which cannot
+    be checkpointed.
+    """
+    if simulator not in ('wntr', 'epanet'):
+        raise ValueError("simulator must be 'wntr' or 'epanet'")
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, cache_key + '.pickle')
+        cache_wn = os.path.join(cache_dir, cache_key + '_wn.pickle')
+        if os.path.isfile(cache_file) and os.path.isfile(cache_wn):
+            with open(cache_file, 'rb') as fp:
+                baseline = pickle.load(fp)
+            # Give the run its own copy of the serialized _wn.
+            fd, wn_pickle = tempfile.mkstemp(prefix='_wn_', suffix='.pickle',
+                                             dir=output_dir)
+            os.close(fd)
+            shutil.copyfile(cache_wn, wn_pickle)
+            return baseline['nodes_below_pmin'], wn_pickle
+
+    hyd_timestep = _wn.options.time.hydraulic_timestep
+    duration = _wn.options.time.duration
+    pause_time = None
+    if checkpoint_time is not None:
+        # Last hydraulic timestep before the event.
+        pause_time = ((checkpoint_time - 1) // hyd_timestep) * hyd_timestep
+        if pause_time < 0 or pause_time >= duration:
+            pause_time = None
     # Original simulation
-    sim = wntr.sim.WNTRSimulator(_wn, mode='PDD')
-    results = sim.run_sim()
-    nzd_pressure = results.node['pressure'].loc[:, nzd_nodes]
-    below_pmin = nzd_pressure[nzd_pressure < pmin].notna()
-    for hr in below_pmin.index:
-        nodes_below_pmin[hr] = []
-        for node in below_pmin.columns:
-            if below_pmin.loc[hr, node]:
-                nodes_below_pmin[hr].append(node)
-    return nodes_below_pmin
+    pressure = []
+    if pause_time is not None:
+        _wn.options.time.duration = pause_time
+        sim = wntr.sim.WNTRSimulator(_wn)
+        results = sim.run_sim()
+        pressure.append(results.node['pressure'])
+        _wn.options.time.duration = duration
+    wn_pickle = _serialize_wn(_wn, output_dir)
+    if simulator == 'epanet':
+        pressure.append(_run_sim(_wn, simulator))
+    else:
+        sim = wntr.sim.WNTRSimulator(_wn)
+        results = sim.run_sim()
+        pressure.append(results.node['pressure'])
+    pressure = pd.concat(pressure)
+
+    nzd_pressure = pressure.loc[:, nzd_nodes]
+    nodes_below_pmin = pd.DataFrame(nzd_pressure.values < pmin,
+                                    index=nzd_pressure.index,
+                                    columns=nzd_pressure.columns)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        baseline = {'nodes_below_pmin': nodes_below_pmin,
+                    'pressure': nzd_pressure}
+        # Write to temp files first so concurrent runs never see a partial
+        # entry.
+        fd, temp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(baseline, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, cache_file)
+        fd, temp = tempfile.mkstemp(dir=cache_dir)
+        os.close(fd)
+        shutil.copyfile(wn_pickle, temp)
+        os.replace(temp, cache_wn)
+    return nodes_below_pmin, wn_pickle
+
+
+def _wn_hash(_wn, output_dir):
+    """Hash the network content, as written to an .inp file."""
+    os.makedirs(output_dir, exist_ok=True)
+    fd, inp_file = tempfile.mkstemp(prefix='_wn_', suffix='.inp',
+                                    dir=output_dir)
+    os.close(fd)
+    try:
+        wntr.epanet.io.InpFile().write(inp_file, _wn)
+        h = hashlib.sha256()
+        with open(inp_file, 'rb') as fp:
+            for line in fp:
+                # Skip comments, which include the time the file was written.
+                if not line.startswith(b';'):
+                    h.update(line)
+    finally:
+        os.remove(inp_file)
+    return h.hexdigest()
+
+
+def _params_key(*params):
+    """Hash a network hash and analysis parameters into a key."""
+    return hashlib.sha256(repr(params).encode()).hexdigest()
+
+
+def _resume_logs(log_dir, run_key, scenarios, resume):
+    """
+    Record the key of this run in log_dir and, if resuming, get the logged
+    results of the scenarios a run with the same key already completed.
+    Failed scenarios are not counted as completed. Otherwise the logs of any
+    earlier run are cleared, so they are never taken for results of this
+    one.
+    """
+    manifest = os.path.join(log_dir, '_run.json')
+    completed = {}
+    logged_key = None
+    if resume and os.path.isfile(manifest):
+        with open(manifest, 'r') as fp:
+            logged_key = json.load(fp).get('key')
+        if logged_key == run_key:
+            for scenario in scenarios:
+                log_file = log_dir + str(scenario) + '.json'
+                if not os.path.isfile(log_file):
+                    continue
+                try:
+                    with open(log_file, 'r') as fp:
+                        val = json.load(fp)
+                except ValueError:
+                    # Partially written when the run was interrupted.
+                    continue
+                if type(val) is dict or val == 'NO AFFECTED NODES':
+                    completed[scenario] = val
+            print('resuming with', len(completed), 'completed scenarios')
+        else:
+            print('logs in', log_dir, 'are from a different network or '
+                  'parameters, running all scenarios')
+    if logged_key != run_key:
+        shutil.rmtree(log_dir)
+        os.makedirs(log_dir)
+    with open(manifest, 'w') as fp:
+        json.dump({'key': run_key}, fp)
+    return completed
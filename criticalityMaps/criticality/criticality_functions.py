@@ -4,21 +4,179 @@ Created on Tue Jun  4 11:33:38 2019
 
 @author: PHassett
 """
-import json
+import os
+import time
 import pickle
+import tempfile
+import numpy as np
 import pandas as pd
 import wntr
+from .telemetry import _scenario_metrics, _SimStats
 
 
-def _fire_criticality(wn_pickle, start, fire_duration, p_min, p_nom, fire_node,
-                      fire_dmnd, nzd_nodes, nodes_below_pmin, results_dir):
-    # print('~'*20 + 'running fire analysis for node' + fire_node + '~'*20)
-    # Reset the wn to original status. Pickle beforehand as needed.
-    with open(wn_pickle, 'rb') as fp:
-        _wn = pickle.load(fp)
-    # Set the simulation characteristics.
+# Length of the demand cycle early stopping compares the pressures over (s).
+_CYCLE = 86400
+
+# Prepared wn loaded by this process and its saved hydraulic state, keyed by
+# the path it was loaded from.
+_wn_cache = {}
+
+
+def _load_wn(wn_pickle, p_nom):
+    """
+    Return the prepared wn stored at wn_pickle, unpickling it only the first
+    time it is requested in this process. Suitable as a runner initializer so
+    each worker loads the wn once at startup.
+    """
+    if wn_pickle not in _wn_cache:
+        with open(wn_pickle, 'rb') as fp:
+            _wn = pickle.load(fp)
+        # Set the simulation characteristics.
+        for name, node in _wn.junctions():
+            node.required_pressure = p_nom
+        # Only keep the wn of the current analysis around.
+        _wn_cache.clear()
+        _wn_cache[wn_pickle] = (_wn, _save_state(_wn))
+        _reset_wn(wn_pickle)
+    return _wn_cache[wn_pickle][0]
+
+
+def _unload_wn(wn_pickle):
+    """Drop the cached wn for wn_pickle, if this process has loaded it."""
+    _wn_cache.pop(wn_pickle, None)
+
+
+def _reset_wn(wn_pickle):
+    """
+    Reset the cached wn to the hydraulic state it was serialized in: the
+    initial state, or the baseline state at the start of the event.
+    """
+    _wn, state = _wn_cache[wn_pickle]
+    sim_time, prev_sim_time, node_state, link_state = state
+    _wn.sim_time = sim_time
+    _wn._prev_sim_time = prev_sim_time
     for name, node in _wn.nodes():
-        node.nominal_pressure = p_nom
+        vars(node).update(node_state[name])
+    for name, link in _wn.links():
+        vars(link).update(link_state[name])
+    for name, control in _wn.controls():
+        control._reset()
+
+
+def _save_state(_wn):
+    # Heads, demands, tank levels, link statuses and settings all live in the
+    # node and link attributes.
+    return (_wn.sim_time, _wn._prev_sim_time,
+            {name: dict(vars(node)) for name, node in _wn.nodes()},
+            {name: dict(vars(link)) for name, link in _wn.links()})
+
+
+def _run_sim(_wn, simulator='wntr', report_start=0, report_timestep=None):
+    """
+    Simulate _wn with the WNTRSimulator ('wntr') or with the EPANET toolkit
+    ('epanet') and get the node pressures of the report times from
+    report_start on, every report_timestep seconds (the report timestep of
+    _wn by default). The EPANET simulator runs the network written to an
+    .inp file, so it always starts from the initial state and its PDD
+    parameters are those in _wn.options.hydraulic.
+
+    Only the pressures of the report times asked for are returned. EPANET
+    writes and reads back nothing else, so the memory of a run falls with the
+    report window. The WNTRSimulator only trims the window it reports: it
+    still builds every node and link result frame of the report times, so
+    with it the window saves no memory beyond a report_timestep that skips
+    the times not needed.
+    """
+    times = _wn.options.time
+    saved = (times.report_start, times.report_timestep)
+    times.report_start = report_start
+    if report_timestep is not None:
+        times.report_timestep = report_timestep
+    try:
+        if simulator == 'epanet':
+            # Each process writes its own EPANET files, as scenarios run
+            # side by side.
+            file_prefix = os.path.join(tempfile.gettempdir(),
+                                       '_wn_epanet_{}'.format(os.getpid()))
+            sim = wntr.sim.EpanetSimulator(
+                _wn, result_types=[wntr.epanet.util.ResultType.pressure])
+            try:
+                results = sim.run_sim(file_prefix=file_prefix,
+                                      convergence_error=True)
+            finally:
+                for ext in ['.inp', '.rpt', '.bin']:
+                    if os.path.isfile(file_prefix + ext):
+                        os.remove(file_prefix + ext)
+            # EPANET reports single precision values.
+            return results.node['pressure'].astype(float)
+        sim = wntr.sim.WNTRSimulator(_wn)
+        results = sim.run_sim(solver_options={'MAXITER': 500})
+        return results.node['pressure'].loc[report_start:]
+    finally:
+        times.report_start, times.report_timestep = saved
+
+
+def _run_break(_wn, simulator, start, early_stop=None):
+    """
+    Simulate a break from start to the duration of _wn and get the node
+    pressures from start on, and the time the simulation was cut short at,
+    or None if it ran the whole break.
+
+    If early_stop is given, the break is simulated a day at a time. Once
+    every pressure at the end of a day is within early_stop (m) of the
+    pressure a day before, the network is repeating its last daily cycle,
+    and the rest of the break would not lower the minimum pressures found,
+    so the simulation stops there. Each day resumes where the last one
+    ended, so early stopping needs the WNTRSimulator.
+    """
+    if early_stop is None:
+        return _run_sim(_wn, simulator, start), None
+    duration = _wn.options.time.duration
+    pressure = []
+    end = start
+    try:
+        while end < duration:
+            end = min(end + _CYCLE, duration)
+            _wn.options.time.duration = end
+            pressure.append(_run_sim(_wn, simulator, start))
+            if end < duration:
+                state = pd.concat(pressure)
+                if end - _CYCLE in state.index and end in state.index:
+                    change = np.abs(state.loc[end].values
+                                    - state.loc[end - _CYCLE].values)
+                    if (change <= early_stop).all():
+                        return state, end
+    finally:
+        _wn.options.time.duration = duration
+    return pd.concat(pressure), None
+
+
+def _min_below_pmin(pressure, p_min, nodes_below_pmin):
+    """
+    Get the lowest pressure of each nzd node that falls below p_min while
+    the baseline at the same report time does not.
+    """
+    values = pressure.values
+    # Remove nodes that are below pressure threshold in base case.
+    impacted = ((values < p_min)
+                & ~nodes_below_pmin.loc[pressure.index].values)
+    min_pressure = np.min(values, axis=0, where=impacted, initial=np.inf)
+    hit = impacted.any(axis=0)
+    # Round off extra decimals
+    return dict(zip(pressure.columns[hit],
+                    min_pressure[hit].round(decimals=5).tolist()))
+
+
+def _fire_criticality(fire_node, wn_pickle, start, fire_duration, p_min, p_nom,
+                      fire_dmnd, nzd_nodes, nodes_below_pmin,
+                      simulator='wntr'):
+    # print('~'*20 + 'running fire analysis for node' + fire_node + '~'*20)
+    metrics = _scenario_metrics()
+    stats = _SimStats()
+    post_start = None
+    load_start = time.time()
+    # Get the prepared wn, loaded once per process.
+    _wn = _load_wn(wn_pickle, p_nom)
     _wn.options.time.duration = (start + fire_duration)
     # Add the fire flow pattern and demand to the fire node
     fire_flow_pattern = wntr.network.elements.Pattern.binary_pattern(
@@ -35,43 +193,53 @@ def _fire_criticality(wn_pickle, start, fire_duration, p_min, p_nom, fire_node,
                                         'Fire flow'))
     unique_results = {}
     try:
-        # Run fire simulation.
-        fire_sim = wntr.sim.WNTRSimulator(_wn, mode='PDD')
-        results = fire_sim.run_sim(solver_options={'MAXITER': 500})
+        metrics['load_time'] = time.time() - load_start
+        # Run fire simulation, reporting the one time the results are
+        # read at.
+        report_time = _wn.options.time.duration - 3600
+        with stats:
+            pressure = _run_sim(_wn, simulator, report_time, report_time)
+        post_start = time.time()
         # Get pressure at nzd nodes that fall below p_min.
-        temp = results.node['pressure'].loc[_wn.options.time.duration - 3600,
-                                            nzd_nodes]
-        temp = temp[temp < p_min]
+        temp = pressure.loc[report_time, nzd_nodes]
+        # Remove nodes that are below pressure threshold in base case.
+        temp = temp[(temp < p_min)
+                    & ~nodes_below_pmin.loc[report_time]]
         # Round off extra decimals
         temp = temp.round(decimals=5)
-        # Remove nodes that are below pressure threshold in base case.
-        unique_results = temp[set(temp.index)
-                              - set(nodes_below_pmin[_wn.sim_time - 3600])]
-        unique_results = unique_results.to_dict()
+        unique_results = temp.to_dict()
 
     except Exception as e:
         unique_results = 'failed: ' + str(e)
+        metrics['failure'] = unique_results
         print(fire_node, ' Failed:', e)
 
     else:
         if len(unique_results.keys()) == 0:
             unique_results = 'NO AFFECTED NODES'
     finally:
-        with open(results_dir + fire_node + '.json', 'w') as fp:
-            json.dump(unique_results, fp)
-        return (fire_node, unique_results)
+        # Undo the fire demand and reset the wn for the next scenario.
+        del node.demand_timeseries_list[-1]
+        _wn.remove_pattern('fire_flow')
+        _reset_wn(wn_pickle)
+        metrics.update(stats.to_dict())
+        if post_start is not None:
+            metrics['post_time'] = time.time() - post_start
+        return (fire_node, unique_results, metrics)
 
 
-def _pipe_criticality(wn_pickle, start, break_duration, p_min, p_nom,
-                      pipe_name, nzd_nodes, nodes_below_pmin, results_dir):
+def _pipe_criticality(pipe_name, wn_pickle, start, break_duration, p_min, p_nom,
+                      nzd_nodes, nodes_below_pmin, simulator='wntr',
+                      early_stop=None):
     # print('~'*20 + ' running pipe criticality for pipe' + pipe_name + '~'*20)
-    # Reset the _wn to original status. Pickle beforehand as needed.
-    with open(wn_pickle, 'rb') as fp:
-        _wn = pickle.load(fp)
-    # Set the simulation characteristics.
-    for name, node in _wn.nodes():
-        node.nominal_pressure = p_nom
+    metrics = _scenario_metrics()
+    stats = _SimStats()
+    post_start = None
+    load_start = time.time()
+    # Get the prepared wn, loaded once per process.
+    _wn = _load_wn(wn_pickle, p_nom)
     _wn.options.time.duration = (start + break_duration)
+    added_controls = []
 
     try:
         # Apply pipe break conditions.
@@ -82,129 +250,92 @@ def _pipe_criticality(wn_pickle, start, break_duration, p_min, p_nom,
         cond = wntr.network.controls.SimTimeCondition(_wn, '=', start)
         ctrl = wntr.network.controls.Control(cond, act)
         _wn.add_control('close pipe ' + pipe_name, ctrl)
-        pipe_sim = wntr.sim.WNTRSimulator(_wn, mode='PDD')
-        results = pipe_sim.run_sim(solver_options={'MAXITER': 500})
+        added_controls.append('close pipe ' + pipe_name)
+        metrics['load_time'] = time.time() - load_start
+        with stats:
+            pressure, stopped_at = _run_break(_wn, simulator, start,
+                                              early_stop)
+        post_start = time.time()
+        if stopped_at is not None:
+            metrics['stopped_at'] = stopped_at
 
         # Get pressure at nzd nodes that fall below p_min.
-        temp = results.node['pressure'].loc[start:
-                                            _wn.options.time.duration,
-                                            nzd_nodes]
-        temp = temp[temp < p_min]
-        # Round off extra decimals
-        temp = temp.round(decimals=5)
-        # Remove nodes that are below pressure threshold in base case.
-        for val in list(temp.index):
-            for node in nodes_below_pmin[val]:
-                temp.loc[val, node] = None
-
-        temp_min = temp.min()
-        for ind in list(temp_min.index):
-            if str(temp_min[ind]) == 'nan':
-                temp_min.pop(ind)
-
-        unique_results = temp_min.to_dict()
+        temp = pressure.loc[start:_wn.options.time.duration, nzd_nodes]
+        unique_results = _min_below_pmin(temp, p_min, nodes_below_pmin)
 
     except Exception as e:
         unique_results = 'failed: ' + str(e)
+        metrics['failure'] = unique_results
         print(pipe_name, ' Failed:', e)
 
     else:
         if len(unique_results.keys()) == 0:
             unique_results = 'NO AFFECTED NODES'
     finally:
-        with open(results_dir + pipe_name + '.json', 'w') as fp:
-            json.dump(unique_results, fp)
-        return (pipe_name, unique_results)
+        # Remove the break controls and reset the wn for the next scenario.
+        for ctrl_name in added_controls:
+            _wn.remove_control(ctrl_name)
+        _reset_wn(wn_pickle)
+        metrics.update(stats.to_dict())
+        if post_start is not None:
+            metrics['post_time'] = time.time() - post_start
+        return (pipe_name, unique_results, metrics)
 
 
-def _segment_criticality(wn_pickle, segment, link_segments, node_segments,
-                         nodes_below_pmin, nzd_nodes, results_dir, start=86400, 
-                         break_duration=172800, p_min=14.06, p_nom=17.58):
+def _segment_criticality(segment, closure_links, wn_pickle,
+                         nodes_below_pmin, nzd_nodes, start=86400, 
+                         break_duration=172800, p_min=14.06, p_nom=17.58,
+                         simulator='wntr', early_stop=None):
     # print('~'*20 + ' running segment criticality for segment' + segment + '~'*20)
-    # Reset the _wn to original status. Pickle beforehand as needed.
-    
-    
-    with open(wn_pickle, 'rb') as fp:
-        _wn = pickle.load(fp)
-      
-    # Set the simulation characteristics.
-    for name, node in _wn.nodes():
-        node.nominal_pressure = p_nom
+    metrics = _scenario_metrics()
+    stats = _SimStats()
+    post_start = None
+    load_start = time.time()
+    # Get the prepared wn, loaded once per process.
+    _wn = _load_wn(wn_pickle, p_nom)
     
     _wn.options.time.duration = start + break_duration
-    
-    # Gather start and end nodes for all pipes
-    start_nodes = _wn.query_link_attribute('start_node_name')
-    end_nodes = _wn.query_link_attribute('end_node_name')
-    links_connected_to_nodes = pd.concat([start_nodes,end_nodes])
+    added_controls = []
     
     try:
-        # Apply pipe break conditions
-        pipes_in_seg = link_segments[link_segments == segment].index
-        nodes_in_seg = node_segments[node_segments == segment].index
-        pipes_list = []
-        
-        # Break each pipe in the segment
-        for pipe in pipes_in_seg:
+        # Break the pipes in the segment and the pipes connected to each
+        # node in the segment.
+        for pipe in closure_links:
             pipe_name = _wn.get_link(pipe)
             act = wntr.network.controls.ControlAction(pipe_name,
                                                   'status',
                                                   wntr.network.LinkStatus.Closed)
-            pipes_list.append(pipe)
             cond = wntr.network.controls.SimTimeCondition(_wn, '=', start)
             ctrl = wntr.network.controls.Control(cond, act)
             _wn.add_control('close pipe ' + pipe, ctrl)
-            # ADDED CHECK
-#            print(_wn.get_control('close pipe ' + pipe))
+            added_controls.append('close pipe ' + pipe)
+        metrics['load_time'] = time.time() - load_start
         
-        # Break pipes connected to each node in the segment
-        for node in nodes_in_seg:
-            node_pipes = links_connected_to_nodes[links_connected_to_nodes==node].index
-            for node_pipe in node_pipes:
-                if not(node_pipe in pipes_list):
-                    pipe_name = _wn.get_link(node_pipe)
-                    act = wntr.network.controls.ControlAction(pipe_name,
-                                                              'status',
-                                                              wntr.network.LinkStatus.Closed)
-                    pipes_list.append(node_pipe)
-                    cond = wntr.network.controls.SimTimeCondition(_wn, '=', start)
-                    ctrl = wntr.network.controls.Control(cond, act)
-                    _wn.add_control('close pipe ' + node_pipe, ctrl)
-                    # ADDED CHECK
-#                    print(_wn.get_control('close pipe ' + node_pipe))
-        
-        pipe_sim = wntr.sim.WNTRSimulator(_wn, mode='PDD')
-        results = pipe_sim.run_sim(solver_options={'MAXITER': 500})
+        with stats:
+            pressure, stopped_at = _run_break(_wn, simulator, start,
+                                              early_stop)
+        post_start = time.time()
+        if stopped_at is not None:
+            metrics['stopped_at'] = stopped_at
     
         # Get pressure at nzd nodes that fall below p_min.
-        temp = results.node['pressure'].loc[start:
-                                            _wn.options.time.duration,
-                                            nzd_nodes]
-        
-        temp = temp[temp < p_min]
-        # Round off extra decimals
-        temp = temp.round(decimals=5)
-        
-        # Remove nodes that are below pressure threshold in base case.
-        for val in list(temp.index):
-            for node in nodes_below_pmin[val]:
-                temp.loc[val, node] = None
-    
-        temp_min = temp.min()
-        for ind in list(temp_min.index):
-            if str(temp_min[ind]) == 'nan':
-                temp_min.pop(ind)
-    
-        unique_results = temp_min.to_dict()
+        temp = pressure.loc[start:_wn.options.time.duration, nzd_nodes]
+        unique_results = _min_below_pmin(temp, p_min, nodes_below_pmin)
         
     except Exception as e:
         unique_results = 'failed: ' + str(e)
+        metrics['failure'] = unique_results
         print('Segment ', segment, ' Failed:', e)
 
     else:
         if len(unique_results.keys()) == 0:
             unique_results = 'NO AFFECTED NODES'
     finally:
-        with open(results_dir + str(segment) + '.json', 'w') as fp:
-            json.dump(unique_results, fp)
-        return (segment, unique_results)
+        # Remove the break controls and reset the wn for the next scenario.
+        for ctrl_name in added_controls:
+            _wn.remove_control(ctrl_name)
+        _reset_wn(wn_pickle)
+        metrics.update(stats.to_dict())
+        if post_start is not None:
+            metrics['post_time'] = time.time() - post_start
+        return (segment, unique_results, metrics)
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Executors that run the scenario tasks of a criticality analysis.
+
+Each executor has a run method that takes the same task list as runner,
+[(func, (arg1, arg2,...,argN))], and hands each func return object to a
+callback as soon as it arrives:
+
+* LocalExecutor - worker processes on this machine, with runner
+* FuturesExecutor - a concurrent.futures ProcessPoolExecutor
+* SocketExecutor - a TCP coordinator that hands tasks out to socket_worker
+  processes, which can run on other machines
+"""
+import os
+import sys
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import collections
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client, wait
+from multiprocessing import AuthenticationError
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .mp_queue_tools import runner
+
+# How often the socket workers are checked for timeouts, in seconds.
+_POLL_TIME = 0.5
+
+
+def _default_workers():
+    return max(1, int(mp.cpu_count() * 0.666))
+
+
+def _task_order(n_tasks, costs):
+    # Most expensive first, if costs are known.
+    if costs is None:
+        return list(range(n_tasks))
+    return sorted(range(n_tasks), key=lambda i: costs[i], reverse=True)
+
+
+class LocalExecutor(object):
+    '''
+    Run tasks in worker processes on this machine, with runner.
+
+    Parameters
+    ----------
+    num_processors: int, optional
+        the number of processors to use. Defaults to None, which uses about
+        66.7% of the machine's cpus.
+
+    start_method: str, optional
+        multiprocessing start method for the workers, see runner
+
+    chunk_size: int, optional
+        number of tasks sent to a worker at a time, see runner. Defaults to
+        None, which sizes the chunks from the observed task run time.
+
+    timeout: int/float, optional
+        wall-clock limit on each task in seconds. Defaults to None (no
+        limit).
+
+    retries: int, optional
+        number of times a task is run again after timing out or after its
+        worker process dies. Defaults to 1.
+    '''
+    def __init__(self, num_processors=None, start_method=None,
+                 chunk_size=None, timeout=None, retries=1):
+        if num_processors is None:
+            num_processors = _default_workers()
+        self.num_workers = num_processors
+        self.start_method = start_method
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+
+    def run(self, tasks, callback, initializer=None, initargs=(),
+            context=None, failed_result=None, costs=None, timings=None,
+            files=(), verbose=True):
+        '''
+        Run the tasks, calling callback with each func return object as it
+        arrives. See runner for the other parameters. files is not used, as
+        the workers share this machine's file system.
+        '''
+        runner(tasks, self.num_workers, initializer=initializer,
+               initargs=initargs, start_method=self.start_method,
+               callback=callback, context=context,
+               chunk_size=self.chunk_size, timeout=self.timeout,
+               retries=self.retries, failed_result=failed_result,
+               costs=costs, timings=timings, verbose=verbose)
+
+
+# Keyword arguments for every task of the current run, set in each
+# FuturesExecutor worker process by _futures_init.
+_futures_context = {}
+
+
+def _futures_init(initializer, initargs, context):
+    _futures_context.clear()
+    _futures_context.update(context)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _futures_call(func, args):
+    start = time.time()
+    result = func(*args, **_futures_context)
+    return result, time.time() - start
+
+
+class FuturesExecutor(object):
+    '''
+    Run tasks in a concurrent.futures ProcessPoolExecutor.
+
+    A task whose worker process dies fails with the pool, so the remaining
+    tasks are failed too; use LocalExecutor to have them retried. Timeouts
+    are not supported.
+
+    Parameters
+    ----------
+    max_workers: int, optional
+        the number of worker processes. Defaults to None, which uses about
+        66.7% of the machine's cpus.
+
+    start_method: str, optional
+        multiprocessing start method for the workers ('spawn', 'fork' or
+        'forkserver'). Defaults to the platform default.
+    '''
+    def __init__(self, max_workers=None, start_method=None):
+        if max_workers is None:
+            max_workers = _default_workers()
+        self.num_workers = max_workers
+        self.start_method = start_method
+
+    def run(self, tasks, callback, initializer=None, initargs=(),
+            context=None, failed_result=None, costs=None, timings=None,
+            files=(), verbose=True):
+        '''
+        Run the tasks, calling callback with each func return object as it
+        arrives. See runner for the other parameters. files is not used, as
+        the workers share this machine's file system, and verbose is not
+        used, as the workers print nothing.
+        '''
+        if context is None:
+            context = {}
+        with ProcessPoolExecutor(self.num_workers,
+                                 mp_context=mp.get_context(self.start_method),
+                                 initializer=_futures_init,
+                                 initargs=(initializer, initargs, context)
+                                 ) as pool:
+            # The pool starts tasks in the order they are submitted.
+            futures = {pool.submit(_futures_call, *tasks[i]): i
+                       for i in _task_order(len(tasks), costs)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result, run_time = future.result()
+                except Exception as e:
+                    reason = 'failed: ' + str(e)
+                    result = (reason if failed_result is None
+                              else failed_result(tasks[i], reason))
+                else:
+                    if timings is not None:
+                        timings[i] = run_time
+                callback(result)
+
+
+def socket_worker(address, authkey):
+    '''
+    Connect to a SocketExecutor and run the tasks it hands out, until it is
+    closed.
+
+    criticalityMaps and wntr must be installed where the worker runs. To
+    start a worker from the command line, run::
+
+        python -m criticalityMaps.criticality.executors HOST PORT
+
+    with the executor's authkey in the CRITICALITYMAPS_AUTHKEY environment
+    variable.
+
+    Parameters
+    ----------
+    address: tuple
+        (host, port) the SocketExecutor listens on
+
+    authkey: bytes
+        the SocketExecutor's authkey
+    '''
+    conn = Client(tuple(address), authkey=authkey)
+    work_dir = tempfile.mkdtemp(prefix='cm_worker_')
+    context = {}
+    try:
+        for message in iter(conn.recv, 'STOP'):
+            if message[0] == 'init':
+                # Start a new run: save its files here and point the
+                # arguments naming them at the local copies.
+                files, initializer, initargs, context = message[1:]
+                local_paths = {}
+                for path, data in files.items():
+                    local_paths[path] = os.path.join(work_dir,
+                                                     os.path.basename(path))
+                    with open(local_paths[path], 'wb') as fp:
+                        fp.write(data)
+                initargs = [local_paths.get(arg, arg)
+                            if isinstance(arg, str) else arg
+                            for arg in initargs]
+                context = {key: local_paths.get(val, val)
+                           if isinstance(val, str) else val
+                           for key, val in context.items()}
+                if initializer is not None:
+                    initializer(*initargs)
+            else:
+                task_id, (func, args) = message
+                start = time.time()
+                result = func(*args, **context)
+                conn.send((task_id, result, time.time() - start))
+    except (EOFError, OSError):
+        # The executor went away, or dropped this worker.
+        pass
+    finally:
+        conn.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class SocketExecutor(object):
+    '''
+    Run tasks on socket_worker processes connected over TCP, which can be
+    on this machine or on other hosts.
+
+    The executor listens on address as soon as it is made. Workers can
+    connect at any time, before or during a run, and stay connected between
+    runs until the executor is closed. Each task goes to one worker at a
+    time. A task whose worker disconnects, or that runs over timeout (the
+    worker is then dropped), is run again up to retries times.
+
+    Tasks and results are pickled over the connections, which are
+    authenticated with authkey. Only run workers for executors you trust,
+    on networks you trust.
+
+    Parameters
+    ----------
+    address: tuple, optional
+        (host, port) to listen on. Defaults to ('localhost', 0), which
+        listens on a free port on this machine only. Use ('', port) to
+        accept workers from other hosts.
+
+    authkey: bytes, optional
+        key the workers must present. Defaults to None, which makes a
+        random key (see the authkey attribute).
+
+    local_workers: int, optional
+        number of socket_worker processes to start on this machine.
+
+        Defaults to 0
+
+    timeout: int/float, optional
+        wall-clock limit on each task in seconds. Defaults to None (no
+        limit).
+
+    retries: int, optional
+        number of times a task is run again after timing out or after its
+        worker disconnects. Defaults to 1.
+
+    worker_wait: int/float, optional
+        how long in seconds a run waits with no worker connected, before
+        any connect or after the last one disconnects. The tasks left are
+        then failed. Defaults to 600. None waits forever.
+    '''
+    def __init__(self, address=('localhost', 0), authkey=None,
+                 local_workers=0, timeout=None, retries=1, worker_wait=600):
+        if authkey is None:
+            authkey = os.urandom(16)
+        self.authkey = authkey
+        self.timeout = timeout
+        self.retries = retries
+        self.worker_wait = worker_wait
+        self._listener = Listener(tuple(address), authkey=authkey)
+        self.address = self._listener.address
+        self._new_conns = queue.Queue()
+        self._conns = []
+        self.num_workers = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+        # Daemonic, so an executor that is never closed does not keep the
+        # program from exiting.
+        self._local = [mp.Process(target=socket_worker,
+                                  args=(self.address, authkey), daemon=True)
+                       for i in range(local_workers)]
+        for process in self._local:
+            process.start()
+
+    def _accept(self):
+        while True:
+            try:
+                self._new_conns.put(self._listener.accept())
+            except AuthenticationError:
+                continue
+            except OSError:
+                # The listener was closed.
+                return
+
+    def run(self, tasks, callback, initializer=None, initargs=(),
+            context=None, failed_result=None, costs=None, timings=None,
+            files=(), verbose=True):
+        '''
+        Run the tasks, calling callback with each func return object as it
+        arrives. See runner for the other parameters.
+
+        files are paths of files the tasks read (e.g. the serialized wn).
+        They are sent to every worker, and any initargs or context value
+        equal to one of them is replaced by the path of the worker's copy.
+        '''
+        if context is None:
+            context = {}
+        file_data = {}
+        for path in files:
+            with open(path, 'rb') as fp:
+                file_data[path] = fp.read()
+        init = ('init', file_data, initializer, tuple(initargs), context)
+
+        n_tasks = len(tasks)
+        pending = collections.deque(_task_order(n_tasks, costs))
+        attempts = [0] * n_tasks
+        finished = [False] * n_tasks
+        idle = []
+        busy = {}
+
+        def add_worker(conn):
+            try:
+                conn.send(init)
+            except OSError:
+                conn.close()
+                return
+            idle.append(conn)
+            self.num_workers = max(self.num_workers, len(idle) + len(busy))
+
+        def finish(task_id, result):
+            if not finished[task_id]:
+                finished[task_id] = True
+                callback(result)
+                return 1
+            return 0
+
+        def lose(conn, task_id, reason):
+            # Drop the worker and run its task again, or give up on it.
+            conn.close()
+            attempts[task_id] += 1
+            if finished[task_id]:
+                return 0
+            elif attempts[task_id] <= self.retries:
+                print('retrying task', task_id, 'after', reason)
+                pending.appendleft(task_id)
+                return 0
+            result = (reason if failed_result is None
+                      else failed_result(tasks[task_id], reason))
+            return finish(task_id, result)
+
+        if verbose:
+            print('running', n_tasks, 'tasks on workers connected to',
+                  self.address)
+        # Carry over the workers of earlier runs.
+        for conn in self._conns:
+            add_worker(conn)
+        n_done = 0
+        no_workers_since = None
+        while n_done < n_tasks:
+            while True:
+                try:
+                    add_worker(self._new_conns.get_nowait())
+                except queue.Empty:
+                    break
+            if idle or busy:
+                no_workers_since = None
+            elif no_workers_since is None:
+                no_workers_since = time.time()
+            elif (self.worker_wait is not None
+                  and time.time() - no_workers_since > self.worker_wait):
+                # Every unfinished task is pending when no worker is left.
+                reason = ('failed: no workers connected for {} s'
+                          .format(self.worker_wait))
+                while pending:
+                    task_id = pending.popleft()
+                    n_done += finish(task_id, reason if failed_result is None
+                                     else failed_result(tasks[task_id], reason))
+                break
+            # Hand the pending tasks to the idle workers.
+            while idle and pending:
+                conn = idle.pop()
+                task_id = pending.popleft()
+                try:
+                    conn.send((task_id, tasks[task_id]))
+                except OSError:
+                    pending.appendleft(task_id)
+                    conn.close()
+                    continue
+                busy[conn] = (task_id, time.time())
+            if not busy:
+                time.sleep(_POLL_TIME)
+                continue
+            for conn in wait(list(busy), timeout=_POLL_TIME):
+                task_id, start = busy.pop(conn)
+                try:
+                    task_id, result, run_time = conn.recv()
+                except (EOFError, OSError):
+                    n_done += lose(conn, task_id,
+                                   'failed: worker disconnected')
+                    continue
+                if timings is not None and not finished[task_id]:
+                    timings[task_id] = run_time
+                n_done += finish(task_id, result)
+                idle.append(conn)
+            if self.timeout is not None:
+                now = time.time()
+                for conn, (task_id, start) in list(busy.items()):
+                    if now - start > self.timeout:
+                        del busy[conn]
+                        n_done += lose(conn, task_id,
+                                       'timed out: ran longer than {} s'
+                                       .format(self.timeout))
+        # Keep the workers for the next run.
+        self._conns = idle + list(busy)
+
+    def close(self):
+        '''Stop the connected workers and stop listening.'''
+        for conn in self._conns:
+            try:
+                conn.send('STOP')
+            except OSError:
+                pass
+            conn.close()
+        self._conns = []
+        self._listener.close()
+        for process in self._local:
+            # Workers dropped for timing out may still be busy.
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    socket_worker((sys.argv[1], int(sys.argv[2])),
+                  os.environ['CRITICALITYMAPS_AUTHKEY'].encode())
@@ -5,23 +5,61 @@ Created on Tue Jun  4 07:59:47 2019
 @author: PHassett
 """
 import multiprocessing as mp
+import collections
+import queue
 import time
 
+# Target run time of a chunk of tasks when sizing chunks adaptively, in
+# seconds. Long enough that the queue round trip of a chunk is small next to
+# the work in it.
+_CHUNK_TIME = 0.2
+# How often the workers are checked for stuck or dead ones, in seconds.
+_POLL_TIME = 0.5
 
-def _execute(function, arguments):
-    result = function(*arguments)
-    print('At {:24}, {:10} completed process: {:4}'.format(time.ctime(),
-          mp.current_process().name, str(mp.current_process().pid)))
-    return result
 
+def _execute(function, arguments, context):
+    return function(*arguments, **context)
 
-def _worker(input_queue, output_queue):
-    for func, args in iter(input_queue.get, 'STOP'):
-        result = _execute(func, args)
-        output_queue.put(result)
 
+def _worker(worker_id, input_queue, output_queue, task_ids, task_starts,
+            initializer=None, initargs=(), context=None, verbose=True):
+    # Do any once-per-worker setup (e.g. loading the wn) before taking tasks.
+    if initializer is not None:
+        initializer(*initargs)
+    if context is None:
+        context = {}
+    for chunk in iter(input_queue.get, 'STOP'):
+        results = []
+        for task_id, (func, args) in chunk:
+            # Let the parent know which task is running and since when.
+            task_start = time.time()
+            task_ids[worker_id] = task_id
+            task_starts[worker_id] = task_start
+            result = _execute(func, args, context)
+            results.append((task_id, result, time.time() - task_start))
+        task_starts[worker_id] = 0
+        # Send the results of the chunk back in one message, with the time
+        # each took.
+        output_queue.put((worker_id, results))
+        if verbose:
+            print('At {:24}, {:10} completed {:4} processes: {:4}'.format(
+                  time.ctime(), mp.current_process().name, len(chunk),
+                  str(mp.current_process().pid)))
 
-def runner(tasks, num_processors):
+
+def _chunk_size(task_time, n_remaining, num_processors):
+    """
+    Size chunks to run for about _CHUNK_TIME, but small enough that the
+    remaining tasks are still spread over all of the workers.
+    """
+    size = int(_CHUNK_TIME / max(task_time, 1e-6))
+    return max(1, min(size, n_remaining // (2 * num_processors)))
+
+
+def runner(tasks, num_processors, initializer=None, initargs=(),
+           start_method=None, callback=None, context=None, chunk_size=None,
+           timeout=None, retries=1, failed_result=None, costs=None,
+           timings=None, verbose=True):
     """
     Run the tasks specified across mutiple processors and return the
     results in a list.
@@ -34,14 +72,78 @@ def runner(tasks, num_processors):
     num_processors - int
         the number of processors to use
 
+    initializer - callable, optional
+        function called once in each worker process before it takes any
+        tasks, e.g. to load the wn shared by all of the tasks
+
+    initargs - tuple, optional
+        arguments passed to initializer
+
+    start_method - str, optional
+        multiprocessing start method for the workers ('spawn', 'fork' or
+        'forkserver'). With 'forkserver', wntr is preloaded in the server
+        process so new workers start with it already imported. Defaults to
+        the platform default.
+
+    callback - callable, optional
+        function called in the parent process with each func return object
+        as soon as it arrives. When given, the results are handed off to it
+        rather than collected, so memory use does not grow with the number
+        of tasks.
+
+    context - dict, optional
+        keyword arguments passed to func of every task. They are sent to
+        each worker once when it starts, rather than with every task, so
+        read-only data shared by all of the tasks (e.g. the baseline
+        results) is only pickled once per worker.
+
+    chunk_size - int, optional
+        number of tasks sent to a worker at a time. The worker returns the
+        results of a chunk in a single message. Defaults to None, which
+        starts with chunks of 1 task and then sizes the chunks from the
+        observed run time of the tasks, so short tasks are batched and long
+        ones are not.
+
+    timeout - int/float, optional
+        wall-clock limit on each task in seconds. The worker of a task that
+        runs longer is stopped and replaced. Defaults to None (no limit).
+
+    retries - int, optional
+        number of times a task is run again after timing out or after its
+        worker process dies (e.g. segfaults or is killed for running out of
+        memory). Defaults to 1.
+
+    failed_result - callable, optional
+        function called as failed_result(task, reason) for a task that is
+        out of retries, returning the object to use as its result. reason
+        starts with 'timed out:' for tasks that timed out and with
+        'failed:' for tasks whose worker died. Defaults to None, which uses
+        reason itself.
+
+    costs - list, optional
+        expected cost (e.g. run time) of each task. The tasks are handed out
+        most expensive first, so that long tasks do not start last and keep
+        one worker busy after the others finish. Defaults to None, which
+        hands out the tasks in order.
+
+    timings - dict, optional
+        dict filled in with the run time in seconds of each task that
+        finished, keyed by the index of the task in tasks.
+
+    verbose - bool, optional
+        print a line as each worker finishes a chunk of tasks. Set it to
+        False when the progress is reported another way, e.g. through
+        callback. Defaults to True.
+
     Returns
     -------
     results - list
-        list of func return objects for each task
+        list of func return objects for each task. Empty if callback is
+        given.
     """
     # Handle undefined num_processors
     if num_processors is None:
-        num_processors = int(mp.cpu_count() * 0.666)
+        num_processors = max(1, int(mp.cpu_count() * 0.666))
     # Do some error checking for the number of processors
     elif type(num_processors) != int:
         raise ValueError('num_processors must of type int')
@@ -54,27 +156,144 @@ def runner(tasks, num_processors):
                          mp.cpu_count()\n\
                          to determine the number of processors.')
 
-    # Create task and return queues.
-    task_queue = mp.Queue()
-    done_queue = mp.Queue()
+    # Get the context to start the workers with.
+    ctx = mp.get_context(start_method)
+    if start_method == 'forkserver':
+        ctx.set_forkserver_preload(['wntr'])
+
+    # Create the return queue, and the shared arrays the workers record
+    # their current task and its start time in.
+    done_queue = ctx.Queue()
+    task_ids = ctx.Array('q', num_processors, lock=False)
+    task_starts = ctx.Array('d', num_processors, lock=False)
+
+    def start_worker(worker_id):
+        task_queue = ctx.Queue()
+        process = ctx.Process(target=_worker,
+                              args=(worker_id, task_queue, done_queue,
+                                    task_ids, task_starts, initializer,
+                                    initargs, context, verbose))
+        process.start()
+        return process, task_queue
 
-    # Submit tasks to the task queue.
-    for task in tasks:
-        task_queue.put(task)
+    # Start worker processes, each with its own task queue so it is known
+    # which worker holds which tasks.
+    workers = [start_worker(i) for i in range(num_processors)]
 
-    # Start worker processes.
-    for i in range(num_processors):
-        mp.Process(target=_worker,
-                   args=(task_queue, done_queue)
-                   ).start()
+    # Tasks are sent to each worker a chunk at a time as it finishes the
+    # last one, so that the chunk size can follow the observed task run
+    # time.
+    n_tasks = len(tasks)
+    if costs is None:
+        pending = collections.deque(range(n_tasks))
+    else:
+        pending = collections.deque(sorted(range(n_tasks),
+                                           key=lambda i: costs[i],
+                                           reverse=True))
+    chunks = [None] * num_processors
+    attempts = [0] * n_tasks
+    finished = [False] * n_tasks
+    size = 1 if chunk_size is None else chunk_size
 
-    # Get the results and store them in a yaml-friendly object.
+    def dispatch(worker_id):
+        chunk = [pending.popleft() for i in range(min(size, len(pending)))]
+        task_ids[worker_id] = chunk[0]
+        task_starts[worker_id] = 0
+        workers[worker_id][1].put([(task_id, tasks[task_id])
+                                   for task_id in chunk])
+        chunks[worker_id] = chunk
+
+    # Get the results and store them in a yaml-friendly object, or hand
+    # them off as they arrive.
     results = []
-    for i in range(len(tasks)):
-        results.append(done_queue.get())
+
+    def finish(task_id, result):
+        # Results of a stopped worker can still arrive after its tasks were
+        # sent out again, so only take the first result of each task.
+        if not finished[task_id]:
+            finished[task_id] = True
+            if callback is None:
+                results.append(result)
+            else:
+                callback(result)
+            return 1
+        return 0
+
+    for worker_id in range(num_processors):
+        if pending:
+            dispatch(worker_id)
+
+    n_done = 0
+    task_time = 0.0
+    n_timed = 0
+    while n_done < n_tasks:
+        try:
+            worker_id, chunk_results = done_queue.get(timeout=_POLL_TIME)
+        except queue.Empty:
+            pass
+        else:
+            for task_id, result, run_time in chunk_results:
+                if timings is not None and not finished[task_id]:
+                    timings[task_id] = run_time
+                n_done += finish(task_id, result)
+            if chunks[worker_id] == [task_id for task_id, result, run_time
+                                     in chunk_results]:
+                chunks[worker_id] = None
+                if chunk_size is None:
+                    task_time += sum(run_time for task_id, result, run_time
+                                     in chunk_results)
+                    n_timed += len(chunk_results)
+                    size = _chunk_size(task_time / n_timed, len(pending),
+                                       num_processors)
+                if pending:
+                    dispatch(worker_id)
+
+        # Replace the workers that died or ran over the timeout, and run
+        # their tasks again.
+        now = time.time()
+        for worker_id, (process, task_queue) in enumerate(workers):
+            if chunks[worker_id] is None:
+                if process.exitcode is not None:
+                    workers[worker_id] = start_worker(worker_id)
+                continue
+            started = task_starts[worker_id]
+            if process.exitcode is not None:
+                reason = ('failed: worker process died (exit code {})'
+                          .format(process.exitcode))
+            elif (timeout is not None and started > 0
+                    and now - started > timeout):
+                reason = 'timed out: ran longer than {} s'.format(timeout)
+                process.terminate()
+            else:
+                continue
+            process.join()
+            stuck = task_ids[worker_id]
+            attempts[stuck] += 1
+            # Put the rest of the chunk back ahead of the other tasks.
+            pending.extendleft(reversed(
+                [task_id for task_id in chunks[worker_id]
+                 if task_id != stuck and not finished[task_id]]))
+            if finished[stuck]:
+                pass
+            elif attempts[stuck] <= retries:
+                print('retrying task', stuck, 'after', reason)
+                pending.appendleft(stuck)
+            else:
+                result = (reason if failed_result is None
+                          else failed_result(tasks[stuck], reason))
+                n_done += finish(stuck, result)
+            chunks[worker_id] = None
+            workers[worker_id] = start_worker(worker_id)
+            if pending:
+                dispatch(worker_id)
+
+        # Hand the pending tasks to any idle workers.
+        for worker_id in range(num_processors):
+            if pending and chunks[worker_id] is None:
+                dispatch(worker_id)
 
     # Stop all child processes.
-    for i in range(num_processors):
+    for process, task_queue in workers:
         task_queue.put('STOP')
 
     # Return the results.
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in cProfile profiling of the scenario runs.
+
+The profiled scenarios are run under cProfile wherever the executor runs
+them, and the raw stats are returned to the analysis with the scenario
+metrics. The analysis merges them into a single report, with the time of
+the profiled scenarios broken down by stage:
+
+* load network - getting the prepared wn (unpickled once per process)
+* build model - building the hydraulic model of the wn for the simulator
+* newton solve - solving each hydraulic timestep
+* save timestep results - copying each solved timestep into the results
+* other simulation - the rest of the simulation (controls, results frames)
+* reset network - resetting the wn for the next scenario
+* setup and post-processing - setting up the scenario and getting its
+  impacted nodes from the results
+
+The time the analysis spends writing the summary and logs of every
+scenario is reported as well.
+"""
+import io
+import cProfile
+import pstats
+
+# (stage, [(file path suffix, function name), ...]) of the stages timed by
+# the cumulative time of their functions.
+_STAGES = [('load network',
+            [('criticality/criticality_functions.py', '_load_wn')]),
+           ('build model', [('sim/hydraulics.py', 'create_hydraulic_model')]),
+           ('newton solve', [('sim/solvers.py', 'solve')]),
+           ('save timestep results', [('sim/hydraulics.py', 'save_results')]),
+           ('reset network',
+            [('criticality/criticality_functions.py', '_reset_wn')])]
+_SIMULATION = ('sim/core.py', 'run_sim')
+
+
+class _Profiled(object):
+    '''
+    Worker function wrapper that runs it under cProfile and adds the raw
+    stats to the metrics of its result.
+    '''
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        profile = cProfile.Profile()
+        key, val, metrics = profile.runcall(self.func, *args, **kwargs)
+        profile.create_stats()
+        metrics['profile'] = profile.stats
+        return (key, val, metrics)
+
+
+class _RawStats(object):
+    # Raw profile stats, in the form pstats loads from a Profile.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class _Profiler(object):
+    '''
+    Choose the scenarios to profile, and merge their stats.
+
+    Parameters
+    ----------
+    sample: bool or float
+        True to profile every scenario, or the fraction of them to profile
+    '''
+    def __init__(self, sample):
+        self.every = 1 if sample is True else max(1, int(round(1 / sample)))
+        self.stats = None
+        self.scenarios = 0
+        self.write_time = 0.0
+        self.worker_names = set()
+
+    def wrap(self, worker, i):
+        """Get the function to run task i with."""
+        if i % self.every == 0:
+            self.worker_names.add(worker.__name__)
+            return _Profiled(worker)
+        return worker
+
+    def add(self, metrics):
+        """Merge in the stats in the metrics of a scenario, if profiled."""
+        stats = metrics.pop('profile', None)
+        if stats is None:
+            return
+        self.scenarios += 1
+        if self.stats is None:
+            self.stats = pstats.Stats(_RawStats(stats))
+        else:
+            self.stats.add(_RawStats(stats))
+
+    def _cumtime(self, functions):
+        total = 0.0
+        for (filename, line, name), stat in self.stats.stats.items():
+            filename = filename.replace('\\', '/')
+            for suffix, func_name in functions:
+                if name == func_name and filename.endswith(suffix):
+                    total += stat[3]
+        return total
+
+    def stages(self):
+        """
+        Get the seconds spent in each stage of the profiled scenarios, as a
+        list of (stage, seconds).
+        """
+        times = {stage: self._cumtime(functions)
+                 for stage, functions in _STAGES}
+        simulation = self._cumtime([_SIMULATION])
+        total = sum(stat[3] for (filename, line, name), stat
+                    in self.stats.stats.items()
+                    if name in self.worker_names and filename.replace(
+                        '\\', '/').endswith('criticality_functions.py'))
+        other_sim = simulation - (times['build model'] + times['newton solve']
+                                  + times['save timestep results'])
+        setup = total - (simulation + times['load network']
+                         + times['reset network'])
+        return [('load network', times['load network']),
+                ('build model', times['build model']),
+                ('newton solve', times['newton solve']),
+                ('save timestep results', times['save timestep results']),
+                ('other simulation', other_sim),
+                ('reset network', times['reset network']),
+                ('setup and post-processing', setup),
+                ('total', total)]
+
+    def report(self, prefix, analysis):
+        """
+        Save the merged stats to prefix + '_profile.prof' and a report of the
+        stages and the top functions to prefix + '_profile.txt'. Returns the
+        stages part of the report.
+        """
+        if self.stats is None:
+            return ''
+        out = io.StringIO()
+        out.write('{} criticality profile of {} scenarios\n\n'.format(
+                  analysis, self.scenarios))
+        stages = self.stages()
+        total = stages[-1][1]
+        out.write('{:<28}{:>12}{:>8}\n'.format('stage', 'time (sec)', '%'))
+        for stage, seconds in stages:
+            out.write('{:<28}{:>12.3f}{:>8.1f}\n'.format(
+                      stage, seconds, 100 * seconds / total if total else 0))
+        out.write('\nsummary and log writes (all scenarios): {:.3f} sec\n\n'
+                  .format(self.write_time))
+        stages_report = out.getvalue()
+        self.stats.stream = out
+        self.stats.sort_stats('cumulative').print_stats(40)
+        self.stats.dump_stats(prefix + '_profile.prof')
+        with open(prefix + '_profile.txt', 'w') as fp:
+            fp.write(out.getvalue())
+        return stages_report
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Criticality analysis results held in a sparse scenario x node matrix.
+"""
+import os
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from .summary import _load_summary, _summary_to_dict
+
+
+class CriticalityResults(object):
+    '''
+    Results of a criticality analysis.
+
+    The lowest observed pressure of each impacted node is stored in a sparse
+    scenario x node matrix, with the scenario and node names held once each.
+    Only the stored entries are impacted nodes, so a stored 0 is a node
+    impacted at 0 pressure.
+
+    Parameters
+    ----------
+    scenarios: array-like
+        key of each node/link/segment tested, one for each row of pressure
+
+    messages: array-like
+        '' for the scenarios with impacted nodes, otherwise the result of the
+        scenario ('NO AFFECTED NODES', 'failed: ...' or 'timed out: ...')
+
+    nodes: array-like
+        names of the nodes, one for each column of pressure
+
+    pressure: scipy.sparse.csr_matrix
+        lowest observed pressure of the impacted nodes of each scenario
+
+    analysis: str, optional
+        type of analysis: 'fire', 'pipe' or 'segment'.
+
+        Defaults to None
+
+    metrics: pandas DataFrame, optional
+        metrics of each scenario run, indexed by scenario. See
+        criticalityMaps.criticality.telemetry for the columns.
+
+        Defaults to None
+    '''
+    def __init__(self, scenarios, messages, nodes, pressure, analysis=None,
+                 metrics=None):
+        self.scenarios = np.asarray(scenarios, dtype=str)
+        self.messages = np.asarray(messages, dtype=str)
+        self.nodes = np.asarray(nodes, dtype=str)
+        self.pressure = pressure
+        self.analysis = analysis
+        self.metrics = metrics
+        self._scenario_ids = {key: i for i, key in enumerate(self.scenarios)}
+
+    @classmethod
+    def from_summary(cls, summary, analysis=None, metrics=None):
+        '''
+        Make the results from summary arrays, as saved in a .npz summary.
+        '''
+        pressure = sparse.csr_matrix((summary['pressure'],
+                                      summary['indices'],
+                                      summary['indptr']),
+                                     shape=(len(summary['scenarios']),
+                                            len(summary['nodes'])))
+        if 'analysis' in summary:
+            analysis = str(summary['analysis'])
+        return cls(summary['scenarios'], summary['messages'],
+                   summary['nodes'], pressure, analysis, metrics)
+
+    @classmethod
+    def load(cls, results_file):
+        '''
+        Load the results from a .yml or .npz summary file.
+
+        A .npz summary saved next to a .yml file is read in its place. The type
+        of analysis is read from .npz summaries that record it, otherwise it
+        is taken from the file name.
+
+        Parameters
+        ----------
+        results_file: str/path-like object
+            path to the .yml or .npz summary file of a criticality analysis
+        '''
+        name = os.path.basename(str(results_file))
+        if 'fire' in name:
+            analysis = 'fire'
+        elif 'segment' in name:
+            analysis = 'segment'
+        elif 'pipe' in name:
+            analysis = 'pipe'
+        else:
+            analysis = None
+        return cls.from_summary(_load_summary(results_file), analysis)
+
+    def save(self, npz_file):
+        '''
+        Save the results to a .npz summary file.
+
+        Parameters
+        ----------
+        npz_file: str/path-like object
+            path to the .npz file
+        '''
+        summary = self.to_summary()
+        if self.analysis is not None:
+            summary['analysis'] = self.analysis
+        np.savez(npz_file, **summary)
+
+    def to_summary(self):
+        '''
+        Get the summary arrays of the results, as saved in a .npz summary.
+        '''
+        return {'scenarios': self.scenarios,
+                'messages': self.messages,
+                'nodes': self.nodes,
+                'indptr': self.pressure.indptr.astype(np.int64),
+                'indices': self.pressure.indices.astype(np.int64),
+                'pressure': self.pressure.data.astype(np.float64)}
+
+    def to_dict(self):
+        '''
+        Get the results in the {key: result} form of a .yml summary.
+        '''
+        return _summary_to_dict(self.to_summary())
+
+    def __len__(self):
+        return len(self.scenarios)
+
+    def impacted_nodes(self, scenario):
+        '''
+        Get the lowest observed pressure of each node impacted by a scenario.
+
+        Parameters
+        ----------
+        scenario: str
+            key of the node/link/segment tested
+
+        Returns
+        -------
+        pressure: pandas Series
+            lowest observed pressure, indexed by impacted node
+        '''
+        i = self._scenario_ids[str(scenario)]
+        start, end = self.pressure.indptr[i], self.pressure.indptr[i + 1]
+        return pd.Series(self.pressure.data[start:end],
+                         index=self.nodes[self.pressure.indices[start:end]])
+
+    def nodes_impacted(self):
+        '''
+        Get the number of nodes impacted by each scenario with impacted
+        nodes.
+
+        Returns
+        -------
+        nodes_impacted: pandas Series
+            number of nodes impacted, indexed by scenario
+        '''
+        impacted = self.messages == ''
+        return pd.Series(self.pressure.getnnz(axis=1)[impacted],
+                         index=self.scenarios[impacted])
+
+    def population_impacted(self, pop):
+        '''
+        Get the population impacted by each scenario with impacted nodes.
+
+        Parameters
+        ----------
+        pop: dict or pandas Series
+            population estimate at each junction. Output from
+            `wntr.metrics.population` is suitable input format.
+
+        Returns
+        -------
+        population_impacted: pandas Series
+            population impacted, indexed by scenario
+        '''
+        impacted = self.messages == ''
+        # Count every stored entry, including nodes impacted at 0 pressure.
+        impacts = sparse.csr_matrix((np.ones(self.pressure.nnz,
+                                             dtype=np.int64),
+                                     self.pressure.indices,
+                                     self.pressure.indptr),
+                                    shape=self.pressure.shape)
+        node_pop = pd.Series(pop).loc[self.nodes].values
+        return pd.Series((impacts @ node_pop)[impacted],
+                         index=self.scenarios[impacted])
+
+    def failed_scenarios(self):
+        '''
+        Get the failure message of each scenario whose simulation failed.
+
+        Returns
+        -------
+        failed: dict
+            failure message, keyed by scenario
+        '''
+        return {key: val for key, val in zip(self.scenarios, self.messages)
+                if 'failed:' in val}
+
+    def timed_out_scenarios(self):
+        '''
+        Get the message of each scenario stopped for running over the
+        timeout of a multiprocess analysis.
+
+        Returns
+        -------
+        timed_out: dict
+            timeout message, keyed by scenario
+        '''
+        return {key: val for key, val in zip(self.scenarios, self.messages)
+                if val.startswith('timed out:')}
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Expected scenario costs, for running the most expensive scenarios first.
+
+Each scenario gets a cheap estimate of its relative cost from the network,
+which is replaced by its measured run time when an earlier run of the same
+network saved one. The estimates of the scenarios without a timing are put
+in seconds by their typical ratio to the timings.
+"""
+import os
+import json
+import heapq
+import numpy as np
+
+
+def _fire_costs(_wn, fire_nodes):
+    """Estimate fire scenario costs by the number of links at the node."""
+    G = _wn.get_graph()
+    return {str(node): float(G.degree(node)) for node in fire_nodes}
+
+
+def _pipe_costs(_wn, pipes):
+    """
+    Estimate pipe closure costs by diameter, as closing a trunk main
+    disturbs more of the network than closing a small pipe.
+    """
+    return {str(pipe): _wn.get_link(pipe).diameter for pipe in pipes}
+
+
+def _segment_costs(closures):
+    """Estimate segment closure costs by the number of links closed."""
+    return {str(segment): float(len(links))
+            for segment, links in closures.items()}
+
+
+def _expected_costs(estimates, timings):
+    """
+    Get the expected cost in seconds of each scenario: its saved timing, or
+    its estimate scaled by the median timing to estimate ratio.
+    """
+    ratios = [timings[key] / estimates[key] for key in estimates
+              if key in timings and estimates[key] > 0]
+    scale = float(np.median(ratios)) if ratios else 1.0
+    return {key: timings.get(key, estimate * scale)
+            for key, estimate in estimates.items()}
+
+
+def _load_timings(timings_file, wn_hash):
+    """Get the saved scenario timings, if they are for the same network."""
+    if os.path.isfile(timings_file):
+        with open(timings_file, 'r') as fp:
+            saved = json.load(fp)
+        if saved.get('network') == wn_hash:
+            return saved['timings']
+    return {}
+
+
+def _save_timings(timings_file, wn_hash, timings):
+    with open(timings_file, 'w') as fp:
+        json.dump({'network': wn_hash, 'timings': timings}, fp)
+
+
+def _makespan(times, num_processors):
+    """
+    Get the time to run tasks taking times, handed out in order to the first
+    of num_processors workers to become free.
+    """
+    finish = [0.0] * num_processors
+    for task_time in times:
+        heapq.heapreplace(finish, finish[0] + task_time)
+    return max(finish)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar .npz criticality summaries.
+
+The .npz summary holds the same results as the .yml summary, laid out in
+compressed sparse row form with interned node names:
+
+* scenarios - key of each node/link/segment tested
+* messages - '' for scenarios with impacted nodes, otherwise the result
+  string ('NO AFFECTED NODES', 'failed: ...' or 'timed out: ...')
+* nodes - names of the impacted nodes
+* indptr - impacted nodes of scenario i are indices[indptr[i]:indptr[i+1]]
+* indices - index into nodes of each impacted node
+* pressure - lowest observed pressure of each impacted node
+* analysis - 'fire', 'pipe' or 'segment', if known
+"""
+import os
+from array import array
+import numpy as np
+import yaml
+
+
+class _SummaryColumns(object):
+    '''
+    Accumulate (key, result) entries as they finish, in columnar form.
+
+    The columns are held in memory until the .npz summary is written, so
+    memory use is O(scenarios): about 80 bytes a scenario for its key, its
+    message and its indptr entry (more for the longer messages of failed
+    ones), plus 16 bytes for each node it impacts (an index and a
+    pressure). Each impacted node name is kept
+    once, however many scenarios impact it.
+    '''
+    def __init__(self):
+        self.scenarios = []
+        self.messages = []
+        self.node_ids = {}
+        self.indptr = array('q', [0])
+        self.indices = array('q')
+        self.pressure = array('d')
+
+    def append(self, result):
+        key, val = result
+        self.scenarios.append(str(key))
+        if type(val) is dict:
+            self.messages.append('')
+            for node, pressure in val.items():
+                node_id = self.node_ids.setdefault(str(node),
+                                                   len(self.node_ids))
+                self.indices.append(node_id)
+                self.pressure.append(float(pressure))
+        else:
+            self.messages.append(str(val))
+        self.indptr.append(len(self.indices))
+
+    def to_arrays(self):
+        return {'scenarios': np.array(self.scenarios, dtype=str),
+                'messages': np.array(self.messages, dtype=str),
+                'nodes': np.array(list(self.node_ids), dtype=str),
+                'indptr': np.array(self.indptr, dtype=np.int64),
+                'indices': np.array(self.indices, dtype=np.int64),
+                'pressure': np.array(self.pressure, dtype=np.float64)}
+
+
+def _npz_file(summary_file):
+    """Get the .npz summary file that goes with a .yml summary file."""
+    return os.path.splitext(summary_file)[0] + '.npz'
+
+
+def _load_summary(summary_file):
+    """
+    Load a criticality summary into columnar arrays.
+
+    Reads the .npz summary if summary_file is one, or if one was written
+    alongside the .yml summary_file (and is not older than it). Otherwise,
+    parses the .yml summary.
+
+    Parameters
+    ----------
+    summary_file: str/path-like object
+        path to the .yml or .npz summary file of a criticality analysis
+
+    Returns
+    -------
+    summary: dict
+        the summary arrays, see the module docstring
+    """
+    npz_file = _npz_file(summary_file)
+    if (str(summary_file).endswith('.npz')
+            or (os.path.isfile(npz_file) and os.path.getmtime(npz_file)
+                >= os.path.getmtime(summary_file))):
+        with np.load(npz_file) as npz:
+            return {key: npz[key] for key in npz.files}
+    # Legacy .yml summary.
+    with open(summary_file, 'r') as fp:
+        summary = yaml.load(fp, Loader=yaml.BaseLoader)
+    columns = _SummaryColumns()
+    for result in summary.items():
+        columns.append(result)
+    return columns.to_arrays()
+
+
+def _summary_to_dict(summary):
+    """
+    Get the {key: result} form of the summary arrays, with the same keys and
+    results as a .yml summary.
+    """
+    nodes = summary['nodes']
+    indptr = summary['indptr']
+    results = {}
+    for i, key in enumerate(summary['scenarios']):
+        if summary['messages'][i] == '':
+            ids = summary['indices'][indptr[i]:indptr[i + 1]]
+            results[key] = dict(zip(nodes[ids],
+                                    summary['pressure'][indptr[i]:indptr[i + 1]]))
+        else:
+            results[key] = summary['messages'][i]
+    return results
+
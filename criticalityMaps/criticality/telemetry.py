@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Per-scenario run metrics and live progress.
+
+Every scenario that is run records:
+
+* worker - host:pid of the process that ran it
+* load_time - seconds to get the prepared wn and set up the scenario
+* sim_time - seconds in the hydraulic simulation
+* post_time - seconds to get the impacted nodes and reset the wn
+* solver_iterations - Newton solver iterations over all hydraulic timesteps
+* timesteps - hydraulic timesteps solved
+  (both '' with the EPANET simulator, which does not report them)
+* stopped_at - sim time a break scenario was cut short at by early
+  stopping, '' if it ran the whole break
+* failure - why the scenario failed or timed out, '' if it did not
+
+The metrics are streamed to a .csv file as the scenarios finish, and only
+read back into memory once the run is done.
+"""
+import os
+import csv
+import time
+import platform
+import pandas as pd
+from wntr.sim.solvers import NewtonSolver
+
+_FIELDS = ['scenario', 'worker', 'load_time', 'sim_time', 'post_time',
+           'solver_iterations', 'timesteps', 'stopped_at', 'failure']
+
+
+def _scenario_metrics():
+    """Start the metrics of a scenario run in this process."""
+    return {'worker': '{}:{}'.format(platform.node(), os.getpid()),
+            'failure': ''}
+
+
+class _SimStats(object):
+    '''
+    Time a WNTRSimulator run and count the Newton solver iterations of each
+    hydraulic timestep, as returned by the solver. The counts are left None
+    if the solver is not called, as with the EPANET simulator.
+    '''
+    def __init__(self):
+        self.sim_time = 0.0
+        self.solver_iterations = None
+        self.timesteps = None
+
+    def __enter__(self):
+        solve = self._solve = NewtonSolver.solve
+
+        def counted_solve(solver, *args, **kwargs):
+            status, message, iterations = solve(solver, *args, **kwargs)
+            self.timesteps = (self.timesteps or 0) + 1
+            self.solver_iterations = ((self.solver_iterations or 0)
+                                      + iterations)
+            return status, message, iterations
+        # The simulator makes its own solvers, so count the solves of any.
+        NewtonSolver.solve = counted_solve
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sim_time += time.time() - self._start
+        NewtonSolver.solve = self._solve
+
+    def to_dict(self):
+        return {'sim_time': self.sim_time,
+                'solver_iterations': self.solver_iterations,
+                'timesteps': self.timesteps}
+
+
+class _Telemetry(object):
+    '''
+    Write the metrics of each finished scenario to fp, and report the
+    progress of the run to progress, if given. Only the count of finished
+    scenarios is kept, so memory use does not grow with the run.
+    '''
+    def __init__(self, fp, total, progress=None):
+        self.fp = fp
+        self.total = total
+        self.progress = progress
+        self.done = 0
+        self._writer = csv.DictWriter(fp, _FIELDS, restval='',
+                                      extrasaction='ignore')
+        self._writer.writeheader()
+        self._start = time.time()
+
+    def record(self, key, metrics):
+        row = dict(metrics, scenario=str(key))
+        self._writer.writerow(row)
+        self.fp.flush()
+        self.done += 1
+        if self.progress is not None:
+            done = self.done
+            elapsed = time.time() - self._start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            self.progress({'scenario': str(key), 'done': done,
+                           'total': self.total, 'elapsed': elapsed,
+                           'rate': rate,
+                           'eta': (self.total - done) / rate if rate else None,
+                           'metrics': row})
+
+    def to_frame(self):
+        # Read the metrics back from the .csv file written so far.
+        self.fp.flush()
+        frame = pd.read_csv(self.fp.name, index_col='scenario',
+                            dtype={'scenario': str, 'worker': str,
+                                   'failure': str})
+        frame['failure'] = frame['failure'].fillna('')
+        return frame
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Connectivity-based screening of pipe and segment closures.
+
+A closure whose only effect is to cut a sourceless part of the network off
+from the rest of the system can be answered without a hydraulic simulation:
+every non-zero demand junction in the cut off part is left at zero pressure,
+while the rest of the network only loses demand. All other closures are left
+for the simulator.
+"""
+import networkx as nx
+
+
+def _segment_closures(G, link_segments, node_segments, segments):
+    """
+    Get the links closed to isolate each segment: the links in the segment
+    and every link connected to a node in the segment.
+
+    Parameters
+    ----------
+    G: networkx MultiDiGraph
+        graph of the wn, from wn.get_graph()
+
+    link_segments: pandas Series
+        segment of each link
+
+    node_segments: pandas Series
+        segment of each node
+
+    segments: iterable
+        segments to get the closures for
+
+    Returns
+    -------
+    closures: dict
+        list of links to close, keyed by segment
+    """
+    links_by_segment = link_segments.groupby(link_segments).groups
+    nodes_by_segment = node_segments.groupby(node_segments).groups
+    closures = {}
+    for segment in segments:
+        links = list(links_by_segment.get(segment, []))
+        seen = set(links)
+        for node in nodes_by_segment.get(segment, []):
+            for u, v, link in G.in_edges(node, keys=True):
+                if link not in seen:
+                    seen.add(link)
+                    links.append(link)
+            for u, v, link in G.out_edges(node, keys=True):
+                if link not in seen:
+                    seen.add(link)
+                    links.append(link)
+        closures[segment] = links
+    return closures
+
+
+def _bridges(U):
+    """Get the names of the links whose closure alone splits the network."""
+    S = nx.Graph()
+    S.add_nodes_from(U)
+    n_parallel = {}
+    for u, v in U.edges():
+        edge = frozenset((u, v))
+        n_parallel[edge] = n_parallel.get(edge, 0) + 1
+        S.add_edge(u, v)
+    bridges = set()
+    for u, v in nx.bridges(S):
+        if n_parallel[frozenset((u, v))] == 1:
+            bridges.update(U[u][v].keys())
+    return bridges
+
+
+def _screen_closures(_wn, closures, nzd_nodes, nodes_below_pmin, start, end):
+    """
+    Resolve the closures that only isolate sourceless parts of the network.
+
+    A closure is resolved when, after closing its links, exactly one part of
+    the network is connected to the tanks and reservoirs, none of the closed
+    links joined two nodes of that part, and each cut off part was attached
+    to it by a single closed link (so no flow passed through it). The nzd
+    nodes of the cut off parts are then reported at 0 pressure, unless they
+    were already below p_min in the baseline at every report time of the
+    closure.
+
+    Parameters
+    ----------
+    _wn: wntr WaterNetworkModel object
+        the prepared wn
+
+    closures: dict
+        list of closed links, keyed by scenario
+
+    nzd_nodes: list
+        non-zero demand junctions
+
+    nodes_below_pmin: pandas DataFrame
+        whether each nzd node is below p_min in the baseline, indexed by
+        report time
+
+    start: int
+        start time of the closure in seconds
+
+    end: int
+        end time of the simulation in seconds
+
+    Returns
+    -------
+    resolved: dict
+        result of each resolved scenario, in the same form as the worker
+        functions return
+    """
+    U = nx.MultiGraph(_wn.get_graph())
+    link_ends = {link: (u, v) for u, v, link in U.edges(keys=True)}
+    bridges = _bridges(U)
+    sources = set(_wn.tank_name_list) | set(_wn.reservoir_name_list)
+    nzd_nodes = set(nzd_nodes)
+    # nzd nodes below p_min in the baseline at every report time of the
+    # closure window.
+    always_low = nodes_below_pmin.loc[start:end].all()
+
+    resolved = {}
+    for scenario, links in closures.items():
+        links = set(links)
+        # A single closed link that is not a bridge cuts nothing off.
+        if len(links) == 1 and not links & bridges:
+            continue
+        H = nx.subgraph_view(U, filter_edge=lambda u, v, k: k not in links)
+        components = list(nx.connected_components(H))
+        sourced = [comp for comp in components if comp & sources]
+        if len(sourced) != 1:
+            continue
+        main = sourced[0]
+        part = {}
+        for comp in components:
+            if comp is not main:
+                root = next(iter(comp))
+                part.update((node, root) for node in comp)
+        if not part or not _single_attachments(
+                [link_ends[link] for link in links], main, part):
+            continue
+        unique_results = {node: 0.0 for node in part.keys() & nzd_nodes
+                          if not always_low[node]}
+        if len(unique_results.keys()) == 0:
+            unique_results = 'NO AFFECTED NODES'
+        resolved[scenario] = unique_results
+    return resolved
+
+
+def _single_attachments(ends, main, part):
+    """
+    Check that no closed link joins two nodes of main and that each cut off
+    part, joined up with the closed links between cut off nodes, is attached
+    to main by a single closed link.
+    """
+    def find(node):
+        while part[node] != node:
+            part[node] = part[part[node]]
+            node = part[node]
+        return node
+
+    for u, v in ends:
+        if u in main and v in main:
+            return False
+        elif u not in main and v not in main:
+            part[find(u)] = find(v)
+    attached = set()
+    for u, v in ends:
+        if u in main or v in main:
+            root = find(v if u in main else u)
+            if root in attached:
+                return False
+            attached.add(root)
+    return True
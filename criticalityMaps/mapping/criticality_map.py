@@ -8,6 +8,7 @@ import os
 import json
 import jinja2
 from criticalityMaps.mapping.geojson_handler import _criticality_yml_to_geojson, inp_to_geojson
+from criticalityMaps.criticality.results import CriticalityResults
 
 
 def make_criticality_map(wn, results_file, output_file=None, pop=None):
@@ -20,13 +21,16 @@ def make_criticality_map(wn, results_file, output_file=None, pop=None):
     wn: wntr waternetwork model
         the wntr waternetwork model of interest
 
-    results_file: str/path-like object
-        path to the .yml results file from a criticality analysis
+    results_file: str/path-like object or CriticalityResults
+        results returned by a criticality analysis, or the path to the .yml
+        or .npz results file from it. A .npz summary saved next to the .yml
+        file is read in its place.
 
     output_file: str/path-like
             path and .html file name for map output.
             Defaults to the path of the results file with '.yml' replaced with
-            '_map.html'
+            '_map.html', or '<analysis>_criticality_map.html' for results
+            passed directly.
 
     pop: dict/Pandas Series, optional
         population estimate at each node. If None, will use
@@ -35,17 +39,23 @@ def make_criticality_map(wn, results_file, output_file=None, pop=None):
         Defaults to None
 
     '''
-    if output_file is None:
-        output_file = results_file.split('.yml')[0] + "_map.html"
+    if isinstance(results_file, CriticalityResults):
+        results = results_file
+        if output_file is None:
+            output_file = str(results.analysis) + "_criticality_map.html"
+    else:
+        results = CriticalityResults.load(results_file)
+        if output_file is None:
+            output_file = os.path.splitext(results_file)[0] + "_map.html"
     # Produce a geojson layer for the wn
     wn_layer = inp_to_geojson(wn, to_file=False)
     # Produce a geojson layer for the criticality results
-    criticality_layer = _criticality_yml_to_geojson(wn, results_file, pop)
+    criticality_layer = _criticality_yml_to_geojson(wn, results, pop)
     # Determine which template to use
-    if 'fire' in results_file:
+    if results.analysis == 'fire':
         html_template = './templates/fire_criticality_template.html'
         data_layer = {'Fire Criticality': criticality_layer}
-    elif 'pipe' in results_file:
+    elif results.analysis == 'pipe':
         html_template = './templates/pipe_criticality_template.html'
         data_layer = {'Pipe Criticality': criticality_layer}
     # Pass geojson layers to fill the template file
@@ -6,10 +6,10 @@ Created on Wed Sep  4 08:42:03 2019
 """
 import os
 import json
-import yaml
 import numpy as np
 import wntr
 from wntr.epanet import FlowUnits
+from criticalityMaps.criticality.results import CriticalityResults
 
 
 def inp_to_geojson(wn, to_file=True):
@@ -75,12 +75,19 @@ def inp_to_geojson(wn, to_file=True):
 
 
 def _criticality_yml_to_geojson(wn, yml_file, pop, to_file=False):
+    # The .json file is named after the summary file, so results objects can
+    # only be converted in memory.
+    if to_file and isinstance(yml_file, CriticalityResults):
+        raise ValueError('to_file needs the path of a summary file, not a '
+                         'CriticalityResults object')
     # Calculate population if it is not defined
     if pop is None:
         pop = wntr.metrics.population(wn)
     # Load each results file and generate a geojson file mapping the results.
-    with open(yml_file, 'r') as fp:
-        summary = yaml.load(fp, Loader=yaml.BaseLoader)
+    if isinstance(yml_file, CriticalityResults):
+        summary = yml_file.to_dict()
+    else:
+        summary = CriticalityResults.load(yml_file).to_dict()
     # Make the GEOJson FeatureCollection object.
     collection = {"type": "FeatureColllection",
                   "features": []
@@ -123,8 +130,11 @@ def _criticality_yml_to_geojson(wn, yml_file, pop, to_file=False):
         elif 'failed:' in val:
             feature["properties"]["Nodes Impacted"] = "SIMULATION FAILED"
             feature["properties"]["Population Impacted"] = "SIMULATION FAILED"
+        elif val.startswith('timed out:'):
+            feature["properties"]["Nodes Impacted"] = "SIMULATION TIMED OUT"
+            feature["properties"]["Population Impacted"] = "SIMULATION TIMED OUT"
         collection["features"].append(feature)
     if to_file:
-        with open(yml_file.split('.yml')[0] + ".json", 'w') as fp:
+        with open(os.path.splitext(yml_file)[0] + ".json", 'w') as fp:
             json.dump(collection, fp)
     return collection
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic water networks of any size, for scaling tests.
+"""
+import itertools
+import collections
+import numpy as np
+import wntr
+
+# Pipe diameters to size from (m): 6, 8, 12, 16, 20, 24, 30, 36 and 48 in.
+# Rounded, so the diameter limits of the analyses (0.1524 m for 6 in) match.
+_DIAMETERS = np.round(np.array([6, 8, 12, 16, 20, 24, 30, 36, 48]) * 0.0254,
+                      4)
+
+# Hourly residential demand multipliers, averaging 1.
+_DIURNAL = np.array([0.6, 0.5, 0.45, 0.45, 0.5, 0.7, 1.0, 1.3, 1.4, 1.3, 1.2,
+                     1.1, 1.1, 1.05, 1.0, 1.0, 1.05, 1.2, 1.35, 1.4, 1.25,
+                     1.0, 0.8, 0.7])
+_DIURNAL = _DIURNAL / _DIURNAL.mean()
+
+# Fraction of the grid's loop closing pipes kept for each topology.
+_LOOP_FRACTIONS = {'grid': 1.0, 'mixed': 0.3, 'tree': 0.0}
+
+
+def synthetic_network(n_junctions, topology='grid', n_sources=1, n_tanks=0,
+                      spacing=100.0, base_demand=2e-4, source_head=60.0,
+                      max_velocity=0.6, seed=None):
+    """
+    Build a synthetic water network of n_junctions junctions.
+
+    The junctions are laid out on a square grid, spacing meters apart. The
+    pipes of a spanning tree of the grid, grown out from the sources, carry
+    the water to every junction, and are sized for the demand downstream of
+    them. The other pipes of the grid close loops, and get the smallest
+    diameter.
+
+    Parameters
+    ----------
+    n_junctions: int
+        number of junctions
+
+    topology: str, optional
+        'grid' (every loop of the grid), 'tree' (branched, no loops) or
+        'mixed' (30% of the loops).
+
+        Defaults to 'grid'.
+
+    n_sources: int, optional
+        number of reservoirs, spread over the network.
+
+        Defaults to 1.
+
+    n_tanks: int, optional
+        number of tanks, spread over the network.
+
+        Defaults to 0.
+
+    spacing: float, optional
+        distance between neighboring junctions and length of the pipes (m).
+
+        Defaults to 100 m.
+
+    base_demand: float, optional
+        mean junction base demand (m^3/s). Each junction gets a base demand
+        between 0.5 and 1.5 times it, with a diurnal demand pattern.
+
+        Defaults to 0.0002 m^3/s (about 3 gpm).
+
+    source_head: float, optional
+        head of the reservoirs above the highest junction (m).
+
+        Defaults to 60 m.
+
+    max_velocity: float, optional
+        velocity the pipes of the spanning tree are sized for at the base
+        demand (m/s). Large networks fed by few sources need lower velocities
+        or more sources to keep their pressures up.
+
+        Defaults to 0.6 m/s.
+
+    seed: int, optional
+        seed for the random demands and elevations.
+
+        Defaults to None.
+
+    Returns
+    -------
+    wn: wntr WaterNetworkModel object
+        the synthetic network
+    """
+    if topology not in _LOOP_FRACTIONS:
+        raise ValueError("topology must be 'grid', 'tree' or 'mixed'")
+    if n_sources < 1 or n_sources > n_junctions:
+        raise ValueError('n_sources must be between 1 and n_junctions')
+    rng = np.random.default_rng(seed)
+    n = n_junctions
+    width = int(np.ceil(np.sqrt(n)))
+    x = (np.arange(n) % width) * spacing
+    y = (np.arange(n) // width) * spacing
+    # Gently rolling terrain.
+    elevation = (10 * np.sin(x / (7.3 * spacing))
+                 * np.cos(y / (5.1 * spacing)) + rng.uniform(0, 2, n) + 20)
+    demand = base_demand * rng.uniform(0.5, 1.5, n)
+
+    # Neighbors on the grid.
+    neighbors = [[] for i in range(n)]
+    for i in range(n):
+        if (i + 1) % width and i + 1 < n:
+            neighbors[i].append(i + 1)
+            neighbors[i + 1].append(i)
+        if i + width < n:
+            neighbors[i].append(i + width)
+            neighbors[i + width].append(i)
+    # Grow a spanning tree out from the sources, breadth first.
+    sources = [int((k + 0.5) * n / n_sources) for k in range(n_sources)]
+    parent = [-1] * n
+    order = []
+    queue = collections.deque(sources)
+    seen = set(sources)
+    while queue:
+        i = queue.popleft()
+        order.append(i)
+        for j in neighbors[i]:
+            if j not in seen:
+                seen.add(j)
+                parent[j] = i
+                queue.append(j)
+    # Size the tree pipes for the demand downstream of them.
+    flow = demand.copy()
+    for i in reversed(order):
+        if parent[i] >= 0:
+            flow[parent[i]] += flow[i]
+    min_area = flow / max_velocity
+    sizes = np.searchsorted(np.pi * _DIAMETERS ** 2 / 4, min_area)
+    diameter = _DIAMETERS[np.minimum(sizes, len(_DIAMETERS) - 1)]
+
+    wn = wntr.network.WaterNetworkModel()
+    wn.name = 'synthetic_{}_{}'.format(topology, n)
+    wn.options.time.hydraulic_timestep = 3600
+    wn.options.time.pattern_timestep = 3600
+    wn.options.time.report_timestep = 3600
+    wn.options.time.duration = 72 * 3600
+    wn.add_pattern('diurnal', list(_DIURNAL))
+    for i in range(n):
+        wn.add_junction('J{}'.format(i), base_demand=demand[i],
+                        demand_pattern='diurnal', elevation=elevation[i],
+                        coordinates=(x[i], y[i]))
+    pipe_ids = itertools.count()
+
+    def add_pipe(start, end, pipe_diameter, length=spacing):
+        wn.add_pipe('P{}'.format(next(pipe_ids)), start, end, length=length,
+                    diameter=pipe_diameter, roughness=100)
+
+    for i in order:
+        if parent[i] >= 0:
+            add_pipe('J{}'.format(parent[i]), 'J{}'.format(i), diameter[i])
+    # Close a share of the loops.
+    loop_fraction = _LOOP_FRACTIONS[topology]
+    for i in range(n):
+        for j in neighbors[i]:
+            if (j > i and parent[j] != i and parent[i] != j
+                    and rng.random() < loop_fraction):
+                add_pipe('J{}'.format(i), 'J{}'.format(j), _DIAMETERS[0])
+    head = elevation.max() + source_head
+    for k, i in enumerate(sources):
+        wn.add_reservoir('R{}'.format(k), base_head=head,
+                         coordinates=(x[i] - spacing / 2, y[i] + spacing / 2))
+        add_pipe('R{}'.format(k), 'J{}'.format(i), diameter[i], spacing / 2)
+    for k in range(n_tanks):
+        # Between the sources, where the pressure sags most.
+        i = int(k * n / n_tanks) + width // 2
+        i = min(i, n - 1)
+        wn.add_tank('T{}'.format(k), elevation=head - 15, init_level=10,
+                    min_level=0, max_level=20, diameter=20,
+                    coordinates=(x[i] + spacing / 2, y[i] + spacing / 2))
+        add_pipe('T{}'.format(k), 'J{}'.format(i), _DIAMETERS[2], spacing / 2)
+    return wn
@@ -17,7 +17,7 @@ INSTALL_REQUIRES = ['networkx',
                     'scipy',
                     'matplotlib',
                     'plotly',
-                    # 'wntr',
+                    'wntr>=1.5',
                     'pyyaml',
                     'utm',
                     'jinja2',
@@ -25,6 +25,7 @@ INSTALL_REQUIRES = ['networkx',
 
 setuptools_kwargs = {
     'zip_safe': False,
+    'python_requires': '>=3.10',
     'install_requires': INSTALL_REQUIRES,
     'scripts': [],
     'include_package_data': True
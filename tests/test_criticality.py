@@ -6,7 +6,10 @@ Created on Tue Sep 24 10:27:50 2019
 """
 import unittest
 import os
+import shutil
+import time
 import yaml
+import pandas as pd
 
 # Get the current directory
 testdir = os.path.dirname(os.path.abspath(str(__file__)))
@@ -14,6 +17,15 @@ datadir = os.path.join(testdir, 'data')
 net3 = os.path.join(testdir, '..', 'examples', 'Net3.inp')
 
 
+def _runner_task(i):
+    # Hang on task 1 and kill the worker on task 2.
+    if i == 1:
+        time.sleep(60)
+    elif i == 2:
+        os._exit(1)
+    return i
+
+
 # run fire and pipe criticality and compare the results files to the expected result
 class TestCriticality(unittest.TestCase):
 
@@ -45,6 +57,24 @@ class TestCriticality(unittest.TestCase):
         except Exception as e:
             raise e
 
+    def test_pipe_criticality_screen_topology(self):
+        try:
+            # Run pipe criticality, resolving isolating closures from the
+            # network connectivity.
+            self.cm.pipe_criticality_analysis(self.wn, post_process=False,
+                                              output_dir=testdir,
+                                              summary_file="pipe_criticality_screen_test.yml",
+                                              screen_topology=True)
+            # Open the output and the benchmark yml files.
+            with open(os.path.join(datadir, "pipe_criticality_benchmark.yml"), 'r') as fp:
+                bench = yaml.load(fp, Loader=yaml.BaseLoader)
+            with open(os.path.join(testdir, "pipe_criticality_screen_test.yml"), 'r') as fp:
+                test = yaml.load(fp, Loader=yaml.BaseLoader)
+            # Assert the results are equal
+            self.assertDictEqual(bench, test)
+        except Exception as e:
+            raise e
+
     def test_fire_criticality(self):
         try:
             # Run pipe criticality with minimal output.
@@ -61,6 +91,481 @@ class TestCriticality(unittest.TestCase):
         except Exception as e:
             raise e
 
+    def test_fire_criticality_metrics(self):
+        try:
+            # Run short fires with minimal output.
+            results = self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                        output_dir=testdir,
+                                                        summary_file="fire_criticality_metrics_test.yml",
+                                                        fire_duration=900)
+            # Assert every scenario reported its metrics
+            metrics = pd.read_csv(os.path.join(testdir, "fire_criticality_metrics_test_metrics.csv"),
+                                  index_col=0, dtype={'scenario': str})
+            self.assertEqual(sorted(metrics.index), sorted(results.scenarios))
+            self.assertEqual(sorted(results.metrics.index), sorted(results.scenarios))
+            self.assertTrue((metrics['solver_iterations'] >= metrics['timesteps']).all())
+            self.assertTrue((metrics['timesteps'] > 0).all())
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_progress(self):
+        try:
+            # Run short fires with minimal output.
+            progress = []
+            results = self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                        output_dir=testdir,
+                                                        summary_file="fire_criticality_progress_test.yml",
+                                                        fire_duration=900,
+                                                        progress=progress.append)
+            # Assert every scenario reported its progress
+            n = len(results.scenarios)
+            self.assertEqual([p['done'] for p in progress], list(range(1, n + 1)))
+            self.assertEqual({p['total'] for p in progress}, {n})
+            self.assertEqual(progress[-1]['eta'], 0)
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_profile(self):
+        try:
+            # Run short fires with minimal output, profiling half of them.
+            results = self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                        output_dir=testdir,
+                                                        summary_file="fire_criticality_profile_test.yml",
+                                                        fire_duration=900,
+                                                        profile=0.5)
+            # Assert half of the scenarios were profiled
+            with open(os.path.join(testdir, "fire_criticality_profile_test_profile.txt"), 'r') as fp:
+                report = fp.read()
+            self.assertIn('profile of {} scenarios'.format((len(results.scenarios) + 1) // 2), report)
+            self.assertIn('newton solve', report)
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_summary(self):
+        try:
+            # Run short fires with minimal output.
+            results = self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                        output_dir=testdir,
+                                                        summary_file="fire_criticality_summary_test.yml",
+                                                        fire_duration=900)
+            with open(os.path.join(testdir, "fire_criticality_summary_test.yml"), 'r') as fp:
+                test = yaml.load(fp, Loader=yaml.BaseLoader)
+            # Assert the .npz summary holds the same results
+            from criticalityMaps.criticality.summary import _load_summary, _summary_to_dict
+            npz = _summary_to_dict(_load_summary(os.path.join(testdir, "fire_criticality_summary_test.npz")))
+            self.assertEqual(test.keys(), npz.keys())
+            for key, val in test.items():
+                if type(val) is dict:
+                    self.assertDictEqual(val, {node: str(pressure) for node, pressure in npz[key].items()})
+                else:
+                    self.assertEqual(val, npz[key])
+            # Assert the returned results hold the same results
+            self.assertDictEqual(npz, results.to_dict())
+        except Exception as e:
+            raise e
+
+    def test_results_load(self):
+        try:
+            from criticalityMaps.criticality.results import CriticalityResults
+            study_dir = os.path.join(testdir, 'fire_study_test')
+            shutil.rmtree(study_dir, ignore_errors=True)
+            os.makedirs(study_dir)
+            # The analysis is taken from the file name, not its directory.
+            yml_file = os.path.join(study_dir, 'pipe_results.yml')
+            shutil.copy(os.path.join(datadir, 'pipe_criticality_benchmark.yml'), yml_file)
+            results = CriticalityResults.load(yml_file)
+            self.assertEqual(results.analysis, 'pipe')
+            # The analysis recorded in a .npz summary wins over its file name.
+            npz_file = os.path.join(study_dir, 'segment_results.npz')
+            results.save(npz_file)
+            self.assertEqual(CriticalityResults.load(npz_file).analysis, 'pipe')
+            self.assertDictEqual(CriticalityResults.load(npz_file).to_dict(),
+                                 results.to_dict())
+            shutil.rmtree(study_dir)
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_checkpoint(self):
+        try:
+            # Run fire criticality from the baseline checkpoint and over the
+            # full horizon.
+            self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                              output_dir=testdir,
+                                              summary_file="fire_criticality_checkpoint_test.yml",
+                                              checkpoint=True)
+            self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                              output_dir=testdir,
+                                              summary_file="fire_criticality_full_test.yml",
+                                              checkpoint=False)
+            with open(os.path.join(testdir, "fire_criticality_full_test.yml"), 'r') as fp:
+                full = yaml.load(fp, Loader=yaml.BaseLoader)
+            with open(os.path.join(testdir, "fire_criticality_checkpoint_test.yml"), 'r') as fp:
+                test = yaml.load(fp, Loader=yaml.BaseLoader)
+            # Assert the same nodes are impacted at pressures within tolerance
+            self.assertEqual(full.keys(), test.keys())
+            for key, val in full.items():
+                if type(val) is dict:
+                    self.assertEqual(val.keys(), test[key].keys())
+                    for node, pressure in val.items():
+                        self.assertAlmostEqual(float(pressure),
+                                               float(test[key][node]),
+                                               places=3)
+                else:
+                    self.assertEqual(val, test[key])
+        except Exception as e:
+            raise e
+
+    def test_baseline_cache(self):
+        try:
+            cache_dir = os.path.join(testdir, 'baseline_cache_test')
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            wn = self.wntr.network.WaterNetworkModel(net3)
+
+            def run():
+                results = self.cm.pipe_criticality_analysis(wn, post_process=False,
+                                                            output_dir=testdir,
+                                                            summary_file="pipe_criticality_cache_test.yml",
+                                                            min_pipe_diam=0.9,
+                                                            baseline_cache=cache_dir)
+                files = {f: os.stat(os.path.join(cache_dir, f)).st_mtime_ns
+                         for f in os.listdir(cache_dir)}
+                return results.to_dict(), files
+            # Assert the baseline and the checkpointed wn are cached
+            first, first_files = run()
+            self.assertEqual(len(first_files), 2)
+            self.assertEqual(len([f for f in first_files if f.endswith('_wn.pickle')]), 1)
+            # Assert the second run reuses them, leaving its copy of the wn
+            # to be removed, with the same results
+            second, second_files = run()
+            self.assertDictEqual(first_files, second_files)
+            self.assertDictEqual(first, second)
+            self.assertEqual([f for f in os.listdir(testdir) if f.startswith('_wn_')], [])
+            # Assert a changed network is simulated again
+            wn.get_node('10').demand_timeseries_list[0].base_value = 0.01
+            third, third_files = run()
+            self.assertEqual(len(third_files), 4)
+            self.assertTrue(set(first_files) < set(third_files))
+            shutil.rmtree(cache_dir)
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_interrupted(self):
+        try:
+            log_dir = os.path.join(testdir, 'log', 'fire_criticality_interrupted_test')
+            shutil.rmtree(log_dir, ignore_errors=True)
+            # Interrupt fire criticality after its first scenario.
+            def interrupt(progress):
+                raise KeyboardInterrupt
+            with self.assertRaises(KeyboardInterrupt):
+                self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                  output_dir=testdir,
+                                                  summary_file="fire_criticality_interrupted_test.yml",
+                                                  progress=interrupt)
+            # Assert the temp files are removed and the logs kept apart
+            self.assertEqual([f for f in os.listdir(testdir) if f.startswith('_wn_')], [])
+            self.assertEqual(len(os.listdir(log_dir)), 2)
+        except Exception as e:
+            raise e
+
+    def test_pipe_criticality_resume(self):
+        try:
+            def run(summary_file, resume=False, stop_after=None, **kwargs):
+                # Run six hour breaks of the largest pipes, from the baseline
+                # checkpoint, interrupted after stop_after scenarios.
+                progress = []
+
+                def report(status):
+                    progress.append(status)
+                    if status['done'] == stop_after:
+                        raise KeyboardInterrupt
+                results = self.cm.pipe_criticality_analysis(self.wn, post_process=False,
+                                                            output_dir=testdir,
+                                                            summary_file=summary_file,
+                                                            min_pipe_diam=0.75,
+                                                            break_duration=21600,
+                                                            resume=resume,
+                                                            progress=report,
+                                                            **kwargs)
+                return results, progress
+            full, progress = run("pipe_criticality_resume_full_test.yml")
+            n_pipes = progress[-1]['total']
+            # Interrupt a run, then resume it
+            with self.assertRaises(KeyboardInterrupt):
+                run("pipe_criticality_resume_test.yml", stop_after=5)
+            resumed, progress = run("pipe_criticality_resume_test.yml", resume=True)
+            # Assert only the rest of the scenarios were run, and the
+            # results were merged
+            self.assertEqual(progress[-1]['total'], n_pipes - 5)
+            self.assertDictEqual(full.to_dict(), resumed.to_dict())
+            # Keep the logs of a run, then interrupt a run with other
+            # parameters and resume it
+            run("pipe_criticality_stale_test.yml", save_log=True)
+            with self.assertRaises(KeyboardInterrupt):
+                run("pipe_criticality_stale_test.yml", stop_after=1, p_min=10)
+            stale, progress = run("pipe_criticality_stale_test.yml", resume=True, p_min=10)
+            # Assert the logs of the first run were not taken as results
+            self.assertEqual(progress[-1]['total'], n_pipes - 1)
+            # Assert resuming without screening does not take the screened
+            # results as simulated
+            run("pipe_criticality_screened_test.yml", screen_topology=True, save_log=True)
+            screened, progress = run("pipe_criticality_screened_test.yml", resume=True)
+            self.assertEqual(progress[-1]['total'], n_pipes)
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_epanet(self):
+        try:
+            # Run fire criticality with the WNTRSimulator and with EPANET.
+            wntr_results = self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                             output_dir=testdir,
+                                                             summary_file="fire_criticality_wntr_test.yml")
+            epanet_results = self.cm.fire_criticality_analysis(self.wn, post_process=False,
+                                                               output_dir=testdir,
+                                                               summary_file="fire_criticality_epanet_test.yml",
+                                                               simulator='epanet')
+            # Assert EPANET leaves the solver counts empty rather than 0
+            self.assertTrue((wntr_results.metrics['timesteps'] > 0).all())
+            self.assertTrue(epanet_results.metrics['solver_iterations'].isnull().all())
+            self.assertTrue(epanet_results.metrics['timesteps'].isnull().all())
+            full = wntr_results.to_dict()
+            test = epanet_results.to_dict()
+            # Assert the same nodes are impacted at pressures within tolerance
+            self.assertEqual(full.keys(), test.keys())
+            for key, val in full.items():
+                if type(val) is dict:
+                    self.assertEqual(val.keys(), test[key].keys())
+                    for node, pressure in val.items():
+                        self.assertAlmostEqual(pressure, test[key][node],
+                                               delta=0.01)
+                else:
+                    self.assertEqual(val, test[key])
+        except Exception as e:
+            raise e
+
+    def test_pipe_criticality_early_stop(self):
+        try:
+            # Run three day breaks of the largest pipes in full and with
+            # early stopping.
+            full_results = self.cm.pipe_criticality_analysis(self.wn, post_process=False,
+                                                             output_dir=testdir,
+                                                             summary_file="pipe_criticality_full_test.yml",
+                                                             break_duration=259200,
+                                                             min_pipe_diam=0.75)
+            early_results = self.cm.pipe_criticality_analysis(self.wn, post_process=False,
+                                                              output_dir=testdir,
+                                                              summary_file="pipe_criticality_early_test.yml",
+                                                              break_duration=259200,
+                                                              min_pipe_diam=0.75,
+                                                              early_stop=0.01)
+            # Assert the breaks that repeat are cut short and noted
+            metrics = pd.read_csv(os.path.join(testdir, "pipe_criticality_early_test_metrics.csv"),
+                                  index_col='scenario')
+            stopped = metrics['stopped_at'].dropna()
+            self.assertTrue(len(stopped) > len(metrics) / 2)
+            self.assertTrue((stopped < 86400 + 259200).all())
+            with open(os.path.join(testdir, "pipe_criticality_early_test.yml"), 'r') as fp:
+                notes = [line for line in fp if line.startswith('#')]
+            self.assertEqual(len(notes), len(stopped))
+            # Assert the same nodes are impacted at the same pressures
+            self.assertTrue(len(full_results.nodes_impacted()) > 0)
+            self.assertDictEqual(full_results.to_dict(), early_results.to_dict())
+            # Assert EPANET, which cannot resume each day, is rejected
+            with self.assertRaises(ValueError):
+                self.cm.pipe_criticality_analysis(self.wn, post_process=False,
+                                                  output_dir=testdir,
+                                                  simulator='epanet',
+                                                  early_stop=0.01)
+        except Exception as e:
+            raise e
+
+    def test_process_criticality(self):
+        try:
+            import tempfile
+            import pandas as pd
+            output_dir = tempfile.mkdtemp()
+            summary_file = os.path.join(datadir, "fire_criticality_benchmark.yml")
+            pop = self.wntr.metrics.population(self.wn)
+            self.cm.process_criticality(self.wn, summary_file, output_dir,
+                                        pop=pop, save_maps=False)
+            csv_summary = pd.read_csv(os.path.join(output_dir, 'pop_node_impacts.csv'),
+                                      index_col=0, dtype={'ID': str})
+            with open(summary_file, 'r') as fp:
+                bench = yaml.load(fp, Loader=yaml.BaseLoader)
+            impacted = {key: val for key, val in bench.items() if type(val) is dict}
+            # Assert the nodes and population impacted of each scenario
+            self.assertEqual(set(impacted), set(csv_summary.index))
+            for key, val in impacted.items():
+                self.assertEqual(len(val), csv_summary.loc[key, 'Nodes Impacted'])
+                self.assertAlmostEqual(pop[list(val)].sum(),
+                                       csv_summary.loc[key, 'Population Impacted'])
+            # Assert results objects give the same output, after a round trip
+            # through a .npz file
+            results = self.cm.CriticalityResults.load(summary_file)
+            self.assertEqual(results.analysis, 'fire')
+            results.save(os.path.join(output_dir, 'results.npz'))
+            results = self.cm.CriticalityResults.load(os.path.join(output_dir, 'results.npz'))
+            self.assertEqual(results.analysis, 'fire')
+            self.assertDictEqual(impacted['143'],
+                                 {node: str(pressure) for node, pressure in
+                                  results.impacted_nodes('143').items()})
+            self.cm.process_criticality(self.wn, results, output_dir,
+                                        pop=pop, save_maps=False)
+            test = pd.read_csv(os.path.join(output_dir, 'pop_node_impacts.csv'),
+                               index_col=0, dtype={'ID': str})
+            self.assertTrue(csv_summary.equals(test))
+            # Assert results objects map like their summary file, but can
+            # not name a .json file
+            from criticalityMaps.mapping.geojson_handler import _criticality_yml_to_geojson
+            self.assertEqual(_criticality_yml_to_geojson(self.wn, results, pop),
+                             _criticality_yml_to_geojson(self.wn, summary_file, pop))
+            with self.assertRaises(ValueError):
+                _criticality_yml_to_geojson(self.wn, results, pop, to_file=True)
+        except Exception as e:
+            raise e
+
+    def test_process_criticality_no_impacts(self):
+        try:
+            import tempfile
+            output_dir = tempfile.mkdtemp()
+            summary_file = os.path.join(output_dir, "fire_criticality_summary.yml")
+            with open(summary_file, 'w') as fp:
+                yaml.dump({'10': 'NO AFFECTED NODES', '20': 'NO AFFECTED NODES'}, fp)
+            self.cm.process_criticality(self.wn, summary_file, output_dir)
+            # Assert the csv is saved, but no maps of nothing
+            self.assertTrue(os.path.isfile(os.path.join(output_dir, 'pop_node_impacts.csv')))
+            self.assertFalse(os.path.isfile(os.path.join(output_dir, 'nodes_impacted_map.pdf')))
+        except Exception as e:
+            raise e
+
+    def test_run_sim_report_window(self):
+        try:
+            from criticalityMaps.criticality.criticality_functions import _run_sim
+            wn = self.wntr.network.WaterNetworkModel(net3)
+            wn.options.time.duration = 6 * 3600
+            for simulator in ['wntr', 'epanet']:
+                # Only the pressures from the report start on are kept.
+                pressure = _run_sim(wn, simulator, 3 * 3600)
+                self.assertEqual(list(pressure.index),
+                                 list(range(3 * 3600, 6 * 3600 + 1, 900)))
+                wn.reset_initial_values()
+                pressure = _run_sim(wn, simulator, 5 * 3600, 5 * 3600)
+                self.assertEqual(list(pressure.index), [5 * 3600])
+                self.assertEqual(pressure.dtypes.unique().tolist(), [float])
+                # The report options of the wn are left as they were.
+                self.assertEqual(wn.options.time.report_start, 0)
+                self.assertEqual(wn.options.time.report_timestep, 900)
+                wn.reset_initial_values()
+        except Exception as e:
+            raise e
+
+    def test_runner_timeout(self):
+        try:
+            results = self.cm.runner([(_runner_task, (i,)) for i in range(4)], 1,
+                                     timeout=2, retries=0)
+            self.assertEqual(sorted(results, key=str),
+                             [0, 3, 'failed: worker process died (exit code 1)',
+                              'timed out: ran longer than 2 s'])
+        except Exception as e:
+            raise e
+
+    def test_runner_costs(self):
+        try:
+            # One worker takes the tasks most expensive first.
+            timings = {}
+            results = self.cm.runner([(_runner_task, (i,)) for i in [3, 4, 5, 6]], 1,
+                                     chunk_size=1, costs=[1, 4, 2, 3],
+                                     timings=timings)
+            self.assertEqual(results, [4, 6, 5, 3])
+            self.assertEqual(sorted(timings), [0, 1, 2, 3])
+        except Exception as e:
+            raise e
+
+    def test_executors(self):
+        try:
+            tasks = [(_runner_task, (i,)) for i in [0, 3, 4, 5, 6, 7]]
+            for executor in [self.cm.LocalExecutor(1),
+                             self.cm.FuturesExecutor(2)]:
+                results = []
+                executor.run(tasks, results.append)
+                self.assertEqual(sorted(results), [0, 3, 4, 5, 6, 7])
+            # Several socket workers on localhost, one of them dropped for
+            # hanging and one lost to a crash.
+            with self.cm.SocketExecutor(local_workers=4, timeout=2,
+                                        retries=0) as executor:
+                results = []
+                timings = {}
+                executor.run([(_runner_task, (i,)) for i in range(6)],
+                             results.append, timings=timings)
+                self.assertEqual(sorted(results, key=str),
+                                 [0, 3, 4, 5, 'failed: worker disconnected',
+                                  'timed out: ran longer than 2 s'])
+                self.assertEqual(sorted(timings), [0, 3, 4, 5])
+                # The remaining workers stay connected for the next run.
+                results = []
+                executor.run(tasks, results.append)
+                self.assertEqual(sorted(results), [0, 3, 4, 5, 6, 7])
+        except Exception as e:
+            raise e
+
+    def test_socket_executor_no_workers(self):
+        try:
+            # With no worker connected, the tasks fail once worker_wait runs
+            # out.
+            with self.cm.SocketExecutor(worker_wait=1) as executor:
+                results = []
+                executor.run([(_runner_task, (i,)) for i in range(3)],
+                             results.append,
+                             failed_result=lambda task, reason: (task[1][0], reason))
+                self.assertEqual(sorted(results),
+                                 [(i, 'failed: no workers connected for 1 s')
+                                  for i in range(3)])
+            # And so do the tasks left when the last worker is lost.
+            with self.cm.SocketExecutor(local_workers=1, retries=0,
+                                        worker_wait=5) as executor:
+                results = []
+                executor.run([(_runner_task, (i,)) for i in [2, 3]],
+                             results.append, costs=[2, 1])
+                self.assertEqual(results, ['failed: worker disconnected',
+                                           'failed: no workers connected for 5 s'])
+        except Exception as e:
+            raise e
+
+    def test_synthetic_network(self):
+        try:
+            for topology in ['grid', 'mixed', 'tree']:
+                wn = self.cm.synthetic_network(50, topology, n_sources=2,
+                                               n_tanks=1, seed=1)
+                self.assertEqual(wn.num_junctions, 50)
+                self.assertEqual(wn.num_reservoirs, 2)
+                self.assertEqual(wn.num_tanks, 1)
+                # A tree from each source to the junctions, plus the loops.
+                if topology == 'tree':
+                    self.assertEqual(wn.num_pipes, 48 + 3)
+                else:
+                    self.assertGreater(wn.num_pipes, 48 + 3)
+            wn.options.time.duration = 6 * 3600
+            sim = self.wntr.sim.WNTRSimulator(wn)
+            results = sim.run_sim()
+            pressure = results.node['pressure'].loc[:, wn.junction_name_list]
+            self.assertGreater(pressure.min().min(), 20)
+        except Exception as e:
+            raise e
+
+    def test_fire_criticality_junctions_only(self):
+        try:
+            # The reservoir of this network feeds it through a fire sized
+            # pipe.
+            wn = self.cm.synthetic_network(9, seed=1)
+            pipe = wn.get_link('P{}'.format(wn.num_pipes - 1))
+            self.assertEqual(pipe.start_node_name, 'R0')
+            results = self.cm.fire_criticality_analysis(wn, post_process=False,
+                                                        output_dir=testdir,
+                                                        summary_file="fire_criticality_junctions_test.yml")
+            # Assert only the junctions took a fire demand
+            self.assertEqual(sorted(results.scenarios), sorted(wn.junction_name_list))
+        except Exception as e:
+            raise e
+
     def test_segment_criticality(self):
         try:
             G = self.wn.get_graph()